@@ -0,0 +1,145 @@
+from evaluation_runner import load_topics, load_qrels
+from preprocessing import remove_custom_stopwords
+import numpy as np
+import pandas as pd
+import pyterrier as pt
+import time
+
+# Worker processes spawned by this script run it again: only the process running it imports the indexes and the
+# database (see worker_pool.py)
+if __name__ == '__main__':
+    from retrieval_custom_preprocess import load_indexes, retriever_registry, native_indexes, query_reducer
+    from retrieval_custom_preprocess import sharded_indexes
+
+''' Compares the query throughput of the scoring engines, the work saved by dynamic pruning and the latency / nDCG
+trade-off of query reduction on the 2021 topics '''
+
+# Number of passes over the topics; the first pass warms the engines up and is not timed
+BENCHMARK_ROUNDS = 3
+
+
+def queries_per_second(search, queries: list, rounds: int = BENCHMARK_ROUNDS):
+    """
+    Runs search on every query for the given number of rounds and returns the queries per second of the timed rounds
+    (all but the first).
+
+    :param search: callable - takes a query string
+    :param queries: list
+    :param rounds: int
+    :return: float
+    """
+    for query in queries:
+        search(query)
+    start = time.perf_counter()
+    for _ in range(rounds - 1):
+        for query in queries:
+            search(query)
+    return len(queries) * (rounds - 1) / (time.perf_counter() - start)
+
+
+def benchmark_engines(queries: list, depths: tuple = (20, 1000), wmodels: tuple = ("BM25", "TF_IDF")):
+    """
+    Measures the queries per second of the Terrier retriever and of the native and sharded indexes of the custom model,
+    one query at a time, for each weighting model and number of results.
+
+    :param queries: list
+    :param depths: tuple
+    :param wmodels: tuple
+    :return: DataFrame
+    """
+    rows = list()
+    native = native_indexes.get('custom')
+    sharded = sharded_indexes.get('custom')
+    for wmodel in wmodels:
+        for depth in depths:
+            retriever = retriever_registry.get('custom', wmodel, depth)
+            row = {"wmodel": wmodel, "k": depth, "terrier_qps": queries_per_second(retriever.search, queries)}
+            if native is not None:
+                row["native_qps"] = queries_per_second(lambda query: native.search(query, wmodel, depth), queries)
+                row["speedup"] = row["native_qps"] / row["terrier_qps"]
+            if sharded is not None:
+                row["sharded_qps"] = queries_per_second(lambda query: sharded.search(query, wmodel, depth), queries)
+            rows.append(row)
+    return pd.DataFrame(rows).round(1)
+
+
+def benchmark_pruning(queries: list, depths: tuple = (10, 100, 1000), wmodel: str = "BM25"):
+    """
+    Compares exhaustive scoring with MaxScore pruning on the native index of the custom model: checks that both return
+    the same top k for every query and reports the postings evaluated per query and the queries per second of each.
+
+    :param queries: list
+    :param depths: tuple
+    :param wmodel: str
+    :return: DataFrame
+    """
+    native = native_indexes['custom']
+    indptr = native.arrays['indptr']
+    postings = list()
+    for query in queries:
+        columns, _ = native.term_ids(query)
+        postings.append(int((indptr[columns + 1] - indptr[columns]).sum()))
+    rows = list()
+    for depth in depths:
+        evaluated, identical = list(), 0
+        for query in queries:
+            docnos, scores = native.search(query, wmodel, depth)
+            pruned_docnos, pruned_scores, count = native.search_maxscore(query, wmodel, depth)
+            identical += docnos == pruned_docnos and np.array_equal(scores, pruned_scores)
+            evaluated.append(count)
+        rows.append({
+            "k": depth,
+            "identical": f"{identical}/{len(queries)}",
+            "postings_per_query": np.mean(postings),
+            "evaluated_per_query": np.mean(evaluated),
+            "evaluated_ratio": sum(evaluated) / max(sum(postings), 1),
+            "exhaustive_qps": queries_per_second(lambda query: native.search(query, wmodel, depth), queries),
+            "maxscore_qps": queries_per_second(lambda query: native.search_maxscore(query, wmodel, depth), queries),
+        })
+    return pd.DataFrame(rows).round(3)
+
+
+def benchmark_query_reduction(topics: pd.DataFrame, qrels: pd.DataFrame, max_terms: tuple = (0, 5, 10, 15, 20),
+                              k: int = 1000):
+    """
+    Reduces the topics to at most each number of terms (0: inferred stopwords removed only), retrieves them one at a
+    time with BM25 on the custom index and reports the query length, latency and nDCG of each setting.
+
+    :param topics: DataFrame - qid, query cleaned of non-word characters
+    :param qrels: DataFrame
+    :param max_terms: tuple
+    :param k: int
+    :return: DataFrame
+    """
+    retriever = retriever_registry.get('custom', "BM25", k)
+    rows = list()
+    for n in max_terms:
+        reduced = [(qid, query_reducer.reduce('custom', query, n)) for qid, query in zip(topics['qid'], topics['query'])]
+        reduced = [(qid, query) for qid, query in reduced if query]
+        for qid, query in reduced:
+            retriever.search(query, qid=qid)  # warm-up pass, not timed
+        latencies, results = list(), list()
+        for qid, query in reduced:
+            start = time.perf_counter()
+            results.append(retriever.search(query, qid=qid))
+            latencies.append((time.perf_counter() - start) * 1000)
+        measures = pt.Experiment([pd.concat(results)], topics, qrels, ['ndcg_cut_10', 'ndcg'], names=[f'max_terms_{n}'])
+        rows.append({
+            "max_terms": n,
+            "terms_per_query": np.mean([len(query.split()) for qid, query in reduced]),
+            "p50_ms": np.percentile(latencies, 50),
+            "p99_ms": np.percentile(latencies, 99),
+            "ndcg_cut_10": measures['ndcg_cut_10'].iloc[0],
+            "ndcg": measures['ndcg'].iloc[0],
+        })
+    return pd.DataFrame(rows).round(3)
+
+
+if __name__ == '__main__':
+    load_indexes()
+    topics = load_topics()
+    topic_queries = [remove_custom_stopwords(query) for query in topics['query']]
+    print(f'\nEngine throughput on {len(topic_queries)} topics:\n\n{benchmark_engines(topic_queries)}')
+    print(f'\nQuery reduction on {len(topics)} topics:\n\n{benchmark_query_reduction(topics, load_qrels())}')
+    if 'custom' in native_indexes:
+        print(f'\nMaxScore pruning on {len(topic_queries)} topics:\n\n{benchmark_pruning(topic_queries)}')
@@ -1,13 +1,24 @@
 from datetime import datetime as dt
-from db import process_clinical_trial, Document, get_clinical_td_matrix, get_documents_for_matrix, process_query
-from db import create_all_indexes
-import datetime
+from trec_parsers import parse_trial
+from worker_pool import process_pool
+import json
 import os
-import pandas as pd
 import pathlib
 
+# The parsing processes spawned by this script run it again: only the process running it imports the database (see
+# worker_pool.py)
+if __name__ == '__main__':
+    from db import get_clinical_td_matrix, get_documents_term_frequencies, process_query
+    from db import create_all_indexes, insert_documents, migrate_term_matrices
+
 ''' Processes the documents and loads the dataset to MongoDB '''
 
+# Documents written to the database per bulk insert, and number of processes parsing the xml files
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+INGEST_PROCESSES = int(os.environ.get('INGEST_PROCESSES', os.cpu_count() or 1))
+# Records how many files of the corpus are in the database, so that an interrupted ingestion resumes where it stopped
+INGEST_CHECKPOINT = os.path.join(os.getcwd(), 'ingest_checkpoint.json')
+
 def judgement():
     """
     Load the .txt file that contain the relevance judgement, then split the data into columns.
@@ -28,15 +39,51 @@ def judgement():
     return unique_values
 
 
-def process_corpus(directory: str):
+def read_checkpoint(checkpoint: str, directory: str):
+    """
+    Returns the number of files of the directory already in the database according to the checkpoint file, 0 if there
+    is no checkpoint for this directory.
+
+    :param checkpoint: str
+    :param directory: str
+    :return: int
     """
-    Adds new documents to the database and adds them to the corpus term-document matrix.
+    if not os.path.isfile(checkpoint):
+        return 0
+    with open(checkpoint, 'r') as f:
+        saved = json.load(f)
+    return saved['done'] if saved.get('directory') == directory else 0
+
+
+def write_checkpoint(checkpoint: str, directory: str, done: int):
+    """
+    Saves the number of files of the directory in the database. The file is replaced atomically.
+
+    :param checkpoint: str
+    :param directory: str
+    :param done: int
+    :return: None
+    """
+    with open(f'{checkpoint}.tmp', 'w') as f:
+        json.dump({'directory': directory, 'done': done}, f)
+    os.replace(f'{checkpoint}.tmp', checkpoint)
+
+
+def process_corpus(directory: str, batch_size: int = INGEST_BATCH_SIZE, processes: int = INGEST_PROCESSES,
+                   checkpoint: str = INGEST_CHECKPOINT):
+    """
+    Adds new documents to the database and queues them for indexing.
 
     Takes the path of the directory containing all the documents as an input and searches through the directory to find
-    the xml files. Then takes each file and adds it to the database and concatenates the document term-frequency matrix
-    with the term-document matrix.
+    the xml files. The files are parsed across a pool of processes and the documents are added to the database with
+    one bulk insert per batch_size files. After each batch the number of files done is saved to the checkpoint file,
+    and the files before it are skipped when the function is run again. Replaying a batch is safe, as documents that
+    already exist are skipped by the database.
 
     :param directory: str
+    :param batch_size: int
+    :param processes: int
+    :param checkpoint: str
     :return: None
     """
     if not os.path.exists(directory):
@@ -53,43 +100,63 @@ def process_corpus(directory: str):
                 file_path = os.path.join(subdir, file)
                 xml_files.append(file_path)
 
-    # Filter through the documents to get xml files with relevance judgements
-    for file_path in xml_files:
+    # Filter through the documents to get xml files with relevance judgements. Sorted so that the checkpoint always
+    # refers to the same files.
+    for file_path in sorted(xml_files):
         doc_id = file_path.split('/')[-1][:-4]
         if doc_id in unique_values:
             filtered_files.append(file_path)
 
-    # process documents
-    for index, doc in enumerate(filtered_files):
-        print(f'processing {index} / {len(filtered_files)} || {round(100 / len(filtered_files) * index)}% || doc name: {doc}')
-        process_clinical_trial(doc)
-    print('corpus processing completed')
-
+    done = read_checkpoint(checkpoint, directory)
+    if done:
+        print(f'resuming from checkpoint: {done} / {len(filtered_files)} files already processed')
 
-def calculate_dt_matrix():
+    # process documents
+    start_time = dt.now()
+    inserted = 0
+    batch = []
+    with process_pool(processes) as pool:
+        for doc in pool.imap(parse_trial, filtered_files[done:], chunksize=16):
+            done += 1
+            if doc is not None:
+                batch.append(doc)
+            if done % batch_size == 0 or done == len(filtered_files):
+                inserted += insert_documents(batch)
+                batch = []
+                write_checkpoint(checkpoint, directory, done)
+                rate = inserted / max((dt.now() - start_time).total_seconds(), 1e-9)
+                print(f'processing {done} / {len(filtered_files)} || {round(100 / len(filtered_files) * done)}% || '
+                      f'{inserted} documents added || {rate:.0f} docs/sec')
+    print(f'corpus processing completed in {dt.now() - start_time}')
+
+
+def calculate_dt_matrix(batch_size: int = 1000):
     """
-    Adds documents to the term-document matrix.
+    Adds every document that is not in the term-document matrix yet, in batches of batch_size documents.
 
+    :param batch_size: int
     :return: None
     """
     print('calculating document term matrix ...')
-    total_time = datetime.timedelta(0)
     start_time = dt.now()
     tdm = get_clinical_td_matrix()
-    matrix = pd.DataFrame()
-    docs = [Document(doc) for doc in get_documents_for_matrix(tdm.matrix.index)]
-    for index, doc in enumerate(docs):
-        matrix = pd.concat([matrix, doc.term_matrix], join='outer')
-        if index % 20 == 0 or index == len(docs) - 1:
-            matrix = matrix.fillna(0.0)
-            tdm.matrix = pd.concat([tdm.matrix, matrix])
-            matrix = pd.DataFrame()
-
-    time_diff = dt.now() - start_time
-    total_time += time_diff
+    existing = set(tdm.doc_ids)
+    doc_ids = []
+    term_frequencies = []
+    for doc in get_documents_term_frequencies(batch_size):
+        doc_id = str(doc['_id'])
+        if doc_id in existing or not doc.get('term_frequencies'):
+            continue
+        doc_ids.append(doc_id)
+        term_frequencies.append(doc['term_frequencies'])
+        if len(doc_ids) == batch_size:
+            tdm.add_documents(doc_ids, term_frequencies)
+            doc_ids, term_frequencies = [], []
+    if doc_ids:
+        tdm.add_documents(doc_ids, term_frequencies)
     tdm.save_matrix()
 
-    print(f'New matrix shape: {tdm.matrix.shape} created in {total_time}')
+    print(f'New matrix shape: {tdm.matrix.shape} created in {dt.now() - start_time}')
     return
 
 
@@ -115,9 +182,11 @@ if __name__ == '__main__':
 
     process_corpus(directory_path)
     #
+    # # Replace the json term matrices of documents added by earlier versions with term vectors
+    migrate_term_matrices()
+    #
     # # Process relevancy
     extract_relevancy_data()
     #
     # # calculate document-term frequency matrix
-    for i in range(500):
-        calculate_dt_matrix()
+    calculate_dt_matrix()
@@ -1,9 +1,16 @@
 from db.services_pymongo import documents, queries, create_all_indexes
 from db.models_document import Document
+from db.models_document_view import DocumentView, CLIENT_PROJECTION
 from db.controllers_document import process_clinical_trial, get_documents_for_matrix, get_documents_terms
 from db.controllers_document import get_documents_for_indexing, get_documents_for_client_with_client_id
-from db.controllers_document import get_documents_for_stop_list
+from db.controllers_document import get_documents_for_indexing_cursor
+from db.controllers_document import get_documents_for_stop_list, get_documents_for_client_by_clinical_id
+from db.controllers_document import get_documents_for_snippets, get_documents_term_frequencies
+from db.controllers_document import queue_document_for_indexing, get_queued_documents, remove_queued_documents
+from db.controllers_document import parse_clinical_trial, insert_documents, queue_documents_for_indexing
+from db.controllers_document import migrate_term_matrices, get_clinical_ids
+from db.controllers_vocabulary import get_term_ids, get_terms, decode_term_vector, decode_term_vectors
 from db.controllers_tdmatrix import get_clinical_td_matrix
-from db.controllers_query import process_query, get_query_list_for_client
+from db.controllers_query import process_query, get_query_list_for_client, topics_parser
 
 # line 3 : get_document_matrix is a new addition from Muriel
@@ -1,9 +1,16 @@
 from bs4 import BeautifulSoup
 from db.models_document import Document
-from db.services_pymongo import documents
-from textanalyser import list_words
-import re
+from db.models_document_view import DocumentView, CLIENT_PROJECTION
+from db.controllers_vocabulary import get_term_ids, get_terms, encode_term_vector, decode_term_vectors
+from db.controllers_vocabulary import term_vector_arrays
+from db.services_pymongo import documents, index_queue
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from trec_parsers import parse_clinical_trial
+import json
 from bson import ObjectId
+from itertools import islice
+import numpy as np
 from pandas import DataFrame
 
 
@@ -39,21 +46,6 @@ def get_soup_text(soup: BeautifulSoup, tag: str):
         return None
 
 
-def find_domain(url: str):
-    """
-    Takes a URL str and returns the domain substring.
-
-    :param url: str
-    :return: str
-    """
-    if url is None:
-        return None
-    if match := re.search(r"//([a-zA-Z.]+)/", url):
-        return match.group(1)
-    elif match := re.search(r"//([a-zA-Z.]+)$", url):
-        return match.group(1)
-
-
 def process_clinical_trial(path: str):
     """
     Process an individual sample from the dataset and add it to the database. Returns an instance of the Document class.
@@ -61,51 +53,106 @@ def process_clinical_trial(path: str):
     :param path: str: the path of the xml file
     :return: Document:
     """
-    try:
-        with open(path) as f:
-            file = f.read()
-    except FileNotFoundError:
-        print(f'Error: file {path} could not be processed')
+    data = parse_clinical_trial(path)
+    if data is None:
         return
-    data = dict()
-    soup = BeautifulSoup(file, 'lxml')
-
-    data['title'] = get_soup_text(soup, 'brief_title')
-    data['url'] = get_url_text(soup, 'url')
-    data['domain'] = find_domain(data['url'])
-    if get_soup_text(soup, 'brief_summary'):
-        data['description'] = get_soup_text(soup, 'brief_summary').replace('\r\n     ', '').strip()
-    else:
-        data['description'] = None
-    data['term_frequencies'] = list_words(get_soup_text(soup, ('id_info', 'brief_title', 'acronym', 'official_title',
-                                                               'sponsors', 'textblock', 'overall_status', 'start_date',
-                                                               'completion_date', 'primary_completion_date', 'phase',
-                                                               'study_type', 'study_design_info','primary_outcome',
-                                                               'secondary_outcome', 'other_outcome', 'enrollment',
-                                                               'condition', 'arm_group', 'intervention',
-                                                               'overall_official', 'location', 'location_countries',
-                                                               'keyword', 'condition_browse', 'intervention_browse',
-                                                               'clinical_results')))['all']
-
-    data['tf_text'] = get_soup_text(soup, ('id_info', 'brief_title', 'acronym', 'official_title',
-                                                               'sponsors', 'textblock', 'overall_status', 'start_date',
-                                                               'completion_date', 'primary_completion_date', 'phase',
-                                                               'study_type', 'study_design_info','primary_outcome',
-                                                               'secondary_outcome', 'other_outcome', 'enrollment',
-                                                               'condition', 'arm_group', 'intervention',
-                                                               'overall_official', 'location', 'location_countries',
-                                                               'keyword', 'condition_browse', 'intervention_browse',
-                                                               'clinical_results'))
-    data['raw_text'] = soup.text
-    data['clinical_id'] = get_soup_text(soup, 'nct_id')
 
     doc = Document(data)
 
-    doc.create_document()
+    if doc.create_document():
+        queue_document_for_indexing(doc.clinical_id)  # picked up by the server's delta index
 
     return doc
 
 
+def insert_documents(docs: list):
+    """
+    Adds a batch of parsed documents (see parse_clinical_trial, with pre-assigned _ids) to the database with one
+    unordered bulk insert and queues them for indexing. Every record is built through Document, so it has the default
+    fields of the model, and the term vectors of the batch are encoded with a single vocabulary lookup. Documents that
+    already exist are skipped. Returns the number of documents inserted.
+
+    :param docs: list
+    :return: int
+    """
+    if not docs:
+        return 0
+    term_ids = get_term_ids(term for doc in docs for term in doc['term_frequencies'])
+    records = list()
+    for doc in docs:
+        document = Document(doc)  # fills in the default fields of the model
+        document.term_vector = encode_term_vector(document.term_frequencies or dict(), term_ids)
+        record = document.info_db()
+        if document._id is not None:
+            record['_id'] = document._id
+        records.append(record)
+    failed = set()
+    try:
+        documents.insert_many(records, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details['writeErrors']:
+            failed.add(error['index'])
+            if error['code'] != 11000:  # duplicate key errors are expected when a batch is replayed
+                print('Error:', error['errmsg'])
+    inserted = [record['clinical_id'] for i, record in enumerate(records) if i not in failed]
+    queue_documents_for_indexing(inserted)
+    return len(inserted)
+
+
+def queue_document_for_indexing(clinical_id: str):
+    """
+    Records that a newly added document has to be added to the search indexes. The server indexes queued documents in a
+    delta index and removes them from the queue once they are merged into the main indexes.
+
+    :param clinical_id: str
+    :return: bool
+    """
+    return queue_documents_for_indexing([clinical_id])
+
+
+def queue_documents_for_indexing(ids: list):
+    """
+    Queues a batch of newly added documents for indexing with one bulk write, see queue_document_for_indexing.
+
+    :param ids: list
+    :return: bool
+    """
+    if not ids:
+        return True
+    try:
+        index_queue.bulk_write([UpdateOne({'clinical_id': clinical_id}, {'$setOnInsert': {'clinical_id': clinical_id}},
+                                          upsert=True) for clinical_id in ids], ordered=False)
+        return True
+    except Exception as e:
+        print('Error:', e)
+        return False
+
+
+def get_queued_documents():
+    """
+    Returns the clinical ids of the documents waiting to be merged into the search indexes, in the order they were
+    queued.
+
+    :return: list
+    """
+    return [doc['clinical_id'] for doc in index_queue.find({}, {'_id': 0, 'clinical_id': 1}).sort('_id', 1)]
+
+
+def remove_queued_documents(ids: list):
+    """
+    Removes documents from the indexing queue once they are merged into the search indexes.
+
+    :param ids: list
+    :return: bool
+    """
+    try:
+        index_queue.delete_many({'clinical_id': {'$in': ids}})
+        return True
+    except Exception as e:
+        print('Error:', e)
+        return False
+
+
 def get_documents_for_matrix(existing_docs: list, limit: int = 10):
     """
     Takes a list of document ids that already exist in the matrix and the number of documents to return. Returns list
@@ -118,47 +165,141 @@ def get_documents_for_matrix(existing_docs: list, limit: int = 10):
     :return: documents
     """
     ids = [ObjectId(i) for i in existing_docs]
-    return documents.find({"_id": {"$nin": ids}}, {'term_matrix': 1}).limit(limit)
+    return documents.find({"_id": {"$nin": ids}}, {'term_vector': 1}).limit(limit)
 
 
-def get_documents_for_stop_list(doc_ids: list):
+def migrate_term_matrices(batch_size: int = 1000):
     """
-    Takes a list of document ids that already exist in the td_matrix and returns the relevant documents
-    of documents.
+    Replaces the json term_matrix and the term_frequencies dictionary of the documents saved by earlier versions with a
+    term vector, in batches of batch_size documents. Returns the number of documents migrated.
+
+    :param batch_size: int
+    :return: int
+    """
+    migrated = 0
+    while True:
+        batch = list(documents.find({'$or': [{'term_matrix': {'$exists': True}},
+                                             {'term_frequencies': {'$exists': True}}]},
+                                    {'term_frequencies': 1, 'term_matrix': 1}).limit(batch_size))
+        if not batch:
+            return migrated
+        term_frequencies = list()
+        for doc in batch:
+            if doc.get('term_frequencies') or not doc.get('term_matrix'):
+                term_frequencies.append(doc.get('term_frequencies') or dict())
+            else:
+                # {term: {document id: count}} as written by DataFrame.to_json
+                term_frequencies.append({term: count for term, row in json.loads(doc['term_matrix']).items()
+                                         for count in row.values() if count})
+        term_ids = get_term_ids(term for tf in term_frequencies for term in tf)
+        documents.bulk_write([UpdateOne({'_id': doc['_id']}, {
+            '$set': {'term_vector': encode_term_vector(tf, term_ids)},
+            '$unset': {'term_matrix': '', 'term_frequencies': ''}}) for doc, tf in zip(batch, term_frequencies)],
+            ordered=False)
+        migrated += len(batch)
+        print(f'migrated {migrated} term matrices')
+
+
+def get_documents_term_frequencies(batch_size: int = 1000):
+    """
+    Yields the _id and term frequencies ({term: count}, decoded from the term vector) of every document. Documents are
+    fetched from the database and decoded in batches, with one vocabulary lookup per batch.
+
+    :param batch_size: int
+    :return: generator(dict)
+    """
+    cursor = documents.find({}, {'_id': 1, 'term_vector': 1}).batch_size(batch_size)
+    while batch := list(islice(cursor, batch_size)):
+        for doc, tf in zip(batch, decode_term_vectors([doc.get('term_vector') for doc in batch])):
+            yield {'_id': doc['_id'], 'term_frequencies': tf}
 
-    This function only returns documents not in the original list.
+
+def get_documents_for_stop_list(doc_ids: list):
+    """
+    Takes a list of document ids that already exist in the td_matrix and returns the clinical id and term frequencies
+    ({term: count}, decoded from the term vector) of those documents.
 
     :param doc_ids: list
-    :return: documents
+    :return: list(dict)
     """
     ids = [ObjectId(i) for i in doc_ids]
-    return documents.find({"_id": {"$in": ids}}, {"_id": 0, "clinical_id": 1, "term_frequencies": 1})
+    docs = list(documents.find({"_id": {"$in": ids}}, {"_id": 0, "clinical_id": 1, "term_vector": 1}))
+    return [{'clinical_id': doc.get('clinical_id'), 'term_frequencies': tf}
+            for doc, tf in zip(docs, decode_term_vectors([doc.get('term_vector') for doc in docs]))]
 
 
-async def get_documents_for_client_with_id(ids: list | None = None):
+def get_documents_for_client_with_id(ids: list | None = None):
     """
+    Blocking pymongo lookup, run it on the hydration executor when called from a request handler.
+
     :param ids: int
     :return: list(documents)
     """
     if ids is not None and len(ids) > 0:
         _ids = [ObjectId(i) for i in ids]
-        docs = documents.find({"_id": {"$in": _ids}}, {'title': 1, 'url': 1, 'description': 1})
+        docs = documents.find({"_id": {"$in": _ids}}, CLIENT_PROJECTION)
     else:
-        docs = documents.find({}).limit(10)
+        docs = documents.find({}, CLIENT_PROJECTION).limit(10)
 
-    return [Document(doc).info_client() for doc in docs]
+    return [DocumentView(doc).info_client() for doc in docs]
 
 
-async def get_documents_for_client_with_client_id(ids: list | None = None):
+def get_documents_for_client_by_clinical_id(ids: list):
     """
+    Takes a list of clinical ids and returns a dictionary of the client information of each document found, keyed by
+    clinical id.
+
+    :param ids: list
+    :return: dict
+    """
+    docs = documents.find({"clinical_id": {"$in": ids}}, CLIENT_PROJECTION)
+    return {doc['clinical_id']: DocumentView(doc).info_client() for doc in docs}
+
+
+def get_documents_for_client_with_client_id(ids: list | None = None):
+    """
+    Blocking pymongo lookup, run it on the hydration executor when called from a request handler. Documents are
+    returned in the order of ids, so that a ranking is preserved.
+
     :param ids: int
     :return: list(documents)
     """
     if ids is not None and len(ids) > 0:
-        docs = documents.find({"clinical_id": {"$in": ids}}, {'title': 1, 'url': 1, 'description': 1})
-    else:
-        docs = documents.find({}).limit(10)
-    return [Document(doc).info_client() for doc in docs]
+        docs = get_documents_for_client_by_clinical_id(ids)
+        return [docs[i] for i in ids if i in docs]
+    docs = documents.find({}, CLIENT_PROJECTION).limit(10)
+    return [DocumentView(doc).info_client() for doc in docs]
+
+
+def get_clinical_ids(ids: list, batch_size: int = 10000):
+    """
+    Takes a list of database _ids (as strings) and returns a {_id: clinical id} dictionary, querying the database in
+    batches.
+
+    :param ids: list
+    :param batch_size: int
+    :return: dict
+    """
+    clinical_ids = dict()
+    for start in range(0, len(ids), batch_size):
+        batch = [ObjectId(i) for i in ids[start:start + batch_size]]
+        for doc in documents.find({"_id": {"$in": batch}}, {"_id": 1, "clinical_id": 1}):
+            clinical_ids[str(doc['_id'])] = doc['clinical_id']
+    return clinical_ids
+
+
+def get_documents_for_snippets(ids: list, batch_size: int = 1000):
+    """
+    Takes a list of clinical ids and yields the fields needed to build the snippet store of an index, querying the
+    database in batches.
+
+    :param ids: list
+    :param batch_size: int
+    :return: generator(dict)
+    """
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        yield from documents.find({"clinical_id": {"$in": batch}}, CLIENT_PROJECTION)
 
 
 def get_documents_for_indexing():
@@ -172,15 +313,29 @@ def get_documents_for_indexing():
     df = df[['clinical_id', 'raw_text']]
     return df
 
-def get_documents_terms():
 
-    '''
+def get_documents_for_indexing_cursor(batch_size: int = 1000, ids: list | None = None):
+    """
+    Returns a cursor over the clinical_id and raw_text of every document, or only of the documents with the given
+    clinical ids, fetched from the database in batches, so that the collection can be streamed into an indexer without
+    being loaded into memory.
+
+    :param batch_size: int
+    :param ids: list | None
+    :return: documents
+    """
+    query = {} if ids is None else {"clinical_id": {"$in": ids}}
+    return documents.find(query, {"_id": 0, "clinical_id": 1, "raw_text": 1}).batch_size(batch_size)
+
+
+def get_documents_terms():
+    """
     Retrieves all documents from the database and return a flat list of all the terms. Used for stopword removal
 
     :return: list
-    '''
-
-    docs = list(documents.find({}, {"_id": 0, "clinical_id": 1, "term_frequencies": 1}))
-    tokens = [item['term_frequencies'].keys() for item in docs]
-    tokens_list = [key for sublist in tokens for key in sublist]
-    return tokens_list
+    """
+    ids = [term_vector_arrays(doc['term_vector'])[0]
+           for doc in documents.find({}, {"_id": 0, "term_vector": 1}) if doc.get('term_vector')]
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+    terms = get_terms(np.unique(ids).tolist())
+    return [terms[term_id] for term_id in ids.tolist()]
@@ -1,17 +1,22 @@
-from bs4 import BeautifulSoup
+from collections import defaultdict
 from db.models_query import Query
 from db.services_pymongo import documents, queries
-import re
+from pymongo import UpdateOne
+from trec_parsers import topics_parser
 
+# Relevance score of each judgement in the qrels file and the query field its documents are stored in
+RELEVANCE_FIELDS = {0: "docs_non_relevant", 1: "docs_excluded", 2: "docs_relevant"}
 
-def get_queries_by_clinical_id(ids: list):
+
+def get_ids_by_clinical_id(ids: list):
     """
-    Takes a list of clinical ids and returns the database _ids for relevant documents
+    Takes a list of clinical ids and returns a {clinical id: database _id} dictionary with one query.
 
     :param ids: list
-    :return: list
+    :return: dict
     """
-    return list(documents.find({"clinical_id": {"$in": ids}}, {"_id": 1}))
+    return {doc["clinical_id"]: doc["_id"]
+            for doc in documents.find({"clinical_id": {"$in": ids}}, {"_id": 1, "clinical_id": 1})}
 
 
 def get_query_list_for_client():
@@ -21,56 +26,55 @@ def get_query_list_for_client():
     return list(map(lambda x: x["content"], queries.find({}, {"_id": 0, "content": 1})))
 
 
-def relevance_parser(relevance_filepath: str):
+def qrels_by_topic(relevance_filepath: str):
     """
-    Takes the Text Retrieval Conference clinical dataset relevancy list and returns a dictionary with labeled
-    information.
+    Reads a Text Retrieval Conference qrels file in one pass and groups the judged clinical ids by topic number and
+    relevance score, in file order: {topic number: {score: [clinical ids]}}.
 
     :param relevance_filepath: str
     :return: dict
     """
+    grouped = defaultdict(lambda: defaultdict(list))
     with open(relevance_filepath, "r") as f:
-        data = f.readlines()
-    relevancy_data = list()
-    for line in data:
-        entry = line.split()
-        relevancy_data.append({"topic_number": entry[0], "clinical_id": entry[2], "score": int(entry[3])})
-    return relevancy_data
+        for line in f:
+            entry = line.split()
+            if len(entry) >= 4:
+                grouped[entry[0]][int(entry[3])].append(entry[2])
+    return grouped
 
 
 def process_query(relevance_filepath: str, query_filepath: str):
     """
     Takes the path of the Text Retrieval Conference clinical dataset relevancy and query lists.
-    Creates database entries for each query.
+    Creates (or refreshes) the database entries for each query.
+
+    The judgements are grouped by topic in one pass over the qrels file, every judged clinical id is resolved to its
+    database _id with a single query and all the topics are written with a single bulk operation.
 
     :param relevance_filepath: str
     :param query_filepath: str
     :return: None
     """
-    relevancy = relevance_parser(relevance_filepath)
-    with open(query_filepath, "r") as f:
-        file = f.read()
-    soup = BeautifulSoup(file, 'lxml')
-    topics = soup.find_all('topic')
-    for index, topic in enumerate(topics):
-        print(f'processing query {index + 1} / {len(topics)} || {round(100 / len(topics) * (index + 1))}%')
-        if match := re.search(r'<topic number=\"([0-9]+)\"', topic.__str__()):
-            topic_number = match.group(1)
-        else:
-            continue
-        trials = list(filter(lambda x: x['topic_number'] == topic_number, relevancy))
-        trials_non_relevant = list(map(lambda x: x['clinical_id'], filter(lambda x: x['score'] == 0, trials)))
-        trials_excluded = list(map(lambda x: x['clinical_id'], filter(lambda x: x['score'] == 1, trials)))
-        trials_relevant = list(map(lambda x: x['clinical_id'], filter(lambda x: x['score'] == 2, trials)))
+    relevancy = qrels_by_topic(relevance_filepath)
+    topics = topics_parser(query_filepath)
+    judged = list({clinical_id for scores in relevancy.values() for ids in scores.values() for clinical_id in ids})
+    ids = get_ids_by_clinical_id(judged)
 
-        query = {
-            "topic_number": topic_number,
-            "content": topic.text.strip(),
-            "docs_relevant": get_queries_by_clinical_id(trials_relevant),
-            "docs_non_relevant": get_queries_by_clinical_id(trials_non_relevant),
-            "docs_excluded": get_queries_by_clinical_id(trials_excluded),
-        }
+    operations = list()
+    for topic_number, content in topics:
+        if topic_number is None:
+            continue
+        query = {"topic_number": topic_number, "content": content}
+        for score, field in RELEVANCE_FIELDS.items():
+            query[field] = [{"_id": ids[clinical_id]} for clinical_id in relevancy[topic_number][score]
+                            if clinical_id in ids]
+        operations.append(UpdateOne({"topic_number": topic_number}, {"$set": Query(query).info_db()}, upsert=True))
 
-        q = Query(query)
-        q.create_document()
+    if operations:
+        try:
+            result = queries.bulk_write(operations, ordered=False)
+            print(f'processed {len(operations)} queries || {result.upserted_count} added || '
+                  f'{result.modified_count} updated')
+        except Exception as e:
+            print('Error: failed to write queries', e)
     return
@@ -4,22 +4,51 @@ import os
 import pickle
 
 
+def migrate_pickled_matrix(matrix: TermDocumentMatrix, pickle_file: str):
+    """
+    Copies the documents of a term document matrix saved as a pickle file by earlier versions into the memory-mapped
+    format of matrix, and saves it.
+
+    :param matrix: TermDocumentMatrix
+    :param pickle_file: str
+    :return: bool
+    """
+    print(f'Migrating {pickle_file} to {matrix.directory}')
+    with open(pickle_file, 'rb') as pf:
+        old = pickle.load(pf).__dict__
+    if type(old.get('matrix')) == DataFrame:
+        # pandas matrix, one row per document and one column per term
+        df = old['matrix']
+        doc_ids = [str(i) for i in df.index]
+        term_frequencies = [{term: count for term, count in row.items() if count == count and count}
+                            for _, row in df.iterrows()]
+    else:
+        # sparse coordinate arrays with every document in memory
+        term_frequencies = [dict() for _ in old['doc_ids']]
+        for row, col, count in zip(old['rows'][:old['nnz']], old['cols'][:old['nnz']], old['counts'][:old['nnz']]):
+            term_frequencies[row][old['terms'][col]] = count
+        doc_ids = old['doc_ids']
+    return matrix.add_documents(doc_ids, term_frequencies) and matrix.save_matrix()
+
+
 def load_matrix(corpus_name: str):
     """
     Determines if an instance of TermDocumentMatrix exists for the corpus and returns it. Else, creates a new one.
 
+    The saved segments are memory-mapped, so loading does not read the matrix into memory.
+
     :param corpus_name: str
     :return: TermDocumentMatrix
     """
-    try:
-        pickle_file = os.path.join(os.getcwd(), f'{corpus_name}.pkl')
-        with open(pickle_file, 'rb') as pf:
-            matrix: TermDocumentMatrix = pickle.load(pf)
+    matrix: TermDocumentMatrix = TermDocumentMatrix({'corpus_name': corpus_name})
+    if matrix.load_matrix():
         return matrix
-    except FileNotFoundError:
-        matrix: TermDocumentMatrix = TermDocumentMatrix({'corpus_name': corpus_name})
+    pickle_file = os.path.join(os.getcwd(), f'{corpus_name}.pkl')
+    if os.path.isfile(pickle_file):
+        migrate_pickled_matrix(matrix, pickle_file)
+    else:
         matrix.save_matrix()
-        return matrix
+    return matrix
 
 
 def get_clinical_td_matrix():
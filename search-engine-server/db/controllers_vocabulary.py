@@ -0,0 +1,123 @@
+from bson.binary import Binary
+from db.services_pymongo import vocabulary, counters
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+import numpy as np
+
+# Term vectors are stored as two little-endian int32 arrays
+VECTOR_DTYPE = np.dtype('<i4')
+
+# term -> term id and term id -> term, filled from the vocabulary collection as terms are used
+term_id_cache = dict()
+term_cache = dict()
+
+
+def cache_terms(entries):
+    """
+    Adds vocabulary entries ({'term', 'term_id'}) to the caches of this process.
+
+    :param entries: iterable
+    :return: None
+    """
+    for entry in entries:
+        term_id_cache[entry['term']] = entry['term_id']
+        term_cache[entry['term_id']] = entry['term']
+
+
+def get_term_ids(terms):
+    """
+    Takes an iterable of terms and returns a {term: term id} dictionary. Terms that are not in the vocabulary yet are
+    given new ids, allocated as one block from a counter so that concurrent writers never reuse an id.
+
+    :param terms: iterable
+    :return: dict
+    """
+    terms = set(terms)
+    missing = [term for term in terms if term not in term_id_cache]
+    if missing:
+        cache_terms(vocabulary.find({'term': {'$in': missing}}, {'_id': 0, 'term': 1, 'term_id': 1}))
+        new = [term for term in missing if term not in term_id_cache]
+        if new:
+            counter = counters.find_one_and_update({'_id': 'term_id'}, {'$inc': {'value': len(new)}}, upsert=True,
+                                                   return_document=ReturnDocument.AFTER)
+            first = counter['value'] - len(new)
+            try:
+                vocabulary.insert_many([{'term': term, 'term_id': first + i} for i, term in enumerate(new)],
+                                       ordered=False)
+            except BulkWriteError as e:
+                # terms added by another process in the meantime keep the id they were given there, any other error
+                # is raised
+                if any(error['code'] != 11000 for error in e.details['writeErrors']) or \
+                        e.details.get('writeConcernErrors'):
+                    raise
+            cache_terms(vocabulary.find({'term': {'$in': new}}, {'_id': 0, 'term': 1, 'term_id': 1}))
+    return {term: term_id_cache[term] for term in terms}
+
+
+def get_terms(term_ids):
+    """
+    Takes an iterable of term ids and returns a {term id: term} dictionary.
+
+    :param term_ids: iterable
+    :return: dict
+    """
+    term_ids = {int(term_id) for term_id in term_ids}
+    missing = [term_id for term_id in term_ids if term_id not in term_cache]
+    if missing:
+        cache_terms(vocabulary.find({'term_id': {'$in': missing}}, {'_id': 0, 'term': 1, 'term_id': 1}))
+    return {term_id: term_cache[term_id] for term_id in term_ids if term_id in term_cache}
+
+
+def encode_term_vector(term_frequencies: dict, term_ids: dict | None = None):
+    """
+    Encodes a {term: count} dictionary as parallel int32 arrays of term ids (sorted) and counts, stored as BSON binary.
+    term_ids can be given when the ids of a whole batch of documents were looked up at once.
+
+    :param term_frequencies: dict
+    :param term_ids: dict | None
+    :return: dict
+    """
+    if term_ids is None:
+        term_ids = get_term_ids(term_frequencies.keys())
+    ids = np.fromiter((term_ids[term] for term in term_frequencies), dtype=VECTOR_DTYPE, count=len(term_frequencies))
+    counts = np.fromiter(term_frequencies.values(), dtype=VECTOR_DTYPE, count=len(term_frequencies))
+    order = np.argsort(ids, kind='stable')
+    return {'term_ids': Binary(ids[order].tobytes()), 'counts': Binary(counts[order].tobytes())}
+
+
+def term_vector_arrays(term_vector: dict):
+    """
+    Returns the term id and count arrays of an encoded term vector, without copying the stored bytes.
+
+    :param term_vector: dict
+    :return: tuple(ndarray, ndarray)
+    """
+    return (np.frombuffer(term_vector['term_ids'], dtype=VECTOR_DTYPE),
+            np.frombuffer(term_vector['counts'], dtype=VECTOR_DTYPE))
+
+
+def decode_term_vectors(term_vectors: list):
+    """
+    Decodes a batch of encoded term vectors into {term: count} dictionaries with a single vocabulary lookup. Missing
+    vectors (None) decode to empty dictionaries.
+
+    :param term_vectors: list
+    :return: list(dict)
+    """
+    arrays = [term_vector_arrays(term_vector) if term_vector else None for term_vector in term_vectors]
+    terms = get_terms(term_id for vector in arrays if vector is not None for term_id in vector[0].tolist())
+    return [dict() if vector is None else
+            {terms[term_id]: count for term_id, count in zip(vector[0].tolist(), vector[1].tolist())}
+            for vector in arrays]
+
+
+def decode_term_vector(term_vector: dict):
+    """
+    Decodes an encoded term vector back into a {term: count} dictionary.
+
+    :param term_vector: dict
+    :return: dict
+    """
+    ids, counts = term_vector_arrays(term_vector)
+    terms = get_terms(ids.tolist())
+    return {terms[term_id]: count for term_id, count in zip(ids.tolist(), counts.tolist())}
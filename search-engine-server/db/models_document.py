@@ -1,7 +1,7 @@
 from db.services_pymongo import documents
+from db.controllers_vocabulary import encode_term_vector, decode_term_vector, term_vector_arrays
 from bson.objectid import ObjectId
 import pandas as pd
-from pandas.core.frame import DataFrame
 
 
 class Document:
@@ -29,9 +29,10 @@ class Document:
 
     references: int - number of times the document has been referenced by other documents in the corpus
 
-    term_frequencies: dict | None - dictionary of terms within the document and their frequency count
+    term_frequencies: dict | None - dictionary of terms within the document and their frequency count, only held in
+    memory: the database stores the term vector
 
-    term_matrix: DataFrame | None - a pandas dataframe representation of term frequencies
+    term_vector: dict | None - the term frequencies encoded as int32 term id and count arrays (BSON binary)
 
     clicks: int - total number of times the document has been viewed
 
@@ -56,7 +57,11 @@ class Document:
 
     update_document: bool - updates the relevant document in the database.
 
-    create_term_matrix: bool - creates a term-matrix for the document and updates the database record with it.
+    create_term_vector: bool - encodes the term frequencies of the document as a term vector.
+
+    term_vector_arrays: tuple - the term id and count arrays of the term vector
+
+    term_matrix: DataFrame | None - a one row pandas dataframe of the term vector, decoded when requested
 
     """
     def __init__(self, doc: dict = None):
@@ -77,7 +82,7 @@ class Document:
         self.links_outgoing: int = 0
         self.references: int = 0
         self.term_frequencies: dict | None = None
-        self.term_matrix: DataFrame | str | None = None
+        self.term_vector: dict | None = None
         self.clicks: int = 0
 
         # Processing status variables
@@ -89,9 +94,8 @@ class Document:
         # If document exists assign each value pair to the respective value pair for class instance
         if doc:
             for k, v in doc.items():
-                setattr(self, k, v)
-            if self.term_matrix and type(self.term_matrix) == str:
-                self.term_matrix = pd.read_json(doc['term_matrix'])
+                if k != 'term_matrix':  # json matrix of older records, replaced by term_vector
+                    setattr(self, k, v)
 
     def info(self):
         """
@@ -112,7 +116,7 @@ class Document:
             "links_outgoing": self.links_outgoing,
             "references": self.references,
             "term_frequencies": self.term_frequencies,
-            "term_matrix": self.term_matrix,
+            "term_vector": self.term_vector,
             "clicks": self.clicks,
 
             "crawled": self.crawled,
@@ -129,8 +133,7 @@ class Document:
         """
         info = self.info()
         del info["_id"]
-        if type(self.term_matrix) == DataFrame:
-            info['term_matrix'] = self.term_matrix.to_json()
+        del info["term_frequencies"]  # stored as term_vector
         return info
 
     def info_client(self):
@@ -152,6 +155,9 @@ class Document:
 
         :return: bool
         """
+        if self.term_frequencies and self.term_vector is None:
+            if not self.create_term_vector():
+                return False
         try:
             inserted = documents.insert_one(self.info_db())
             self._id = ObjectId(inserted.inserted_id)
@@ -161,8 +167,6 @@ class Document:
             else:
                 print(f'An error occurred creating a document with url {self.url}', e)
             return False
-        if self._id and self.term_frequencies:
-            self.create_term_matrix()
 
         return True
 
@@ -179,16 +183,37 @@ class Document:
             print(f'Document with id {self._id} could not be updated', e)
             return False
 
-    def create_term_matrix(self):
+    def create_term_vector(self):
         """
-        Creates a term-matrix for the document and updates the database record with it.
+        Encodes the term frequencies of the document as a term vector. The vector is saved with the document by
+        create_document or update_document.
 
         :return: bool
         """
         try:
-            self.term_matrix = pd.DataFrame(self.term_frequencies, index=[str(self._id), ])
-            self.update_document()
+            self.term_vector = encode_term_vector(self.term_frequencies or dict())
             return True
         except Exception as e:
             print('Error:', e)
             return False
+
+    def term_vector_arrays(self):
+        """
+        Returns the term id and count arrays (int32) of the term vector, or None if the document has none.
+
+        :return: tuple(ndarray, ndarray) | None
+        """
+        if not self.term_vector:
+            return None
+        return term_vector_arrays(self.term_vector)
+
+    @property
+    def term_matrix(self):
+        """
+        A one row pandas dataframe indexed by the document id with a column per term, decoded from the term vector.
+
+        :return: DataFrame | None
+        """
+        if not self.term_vector:
+            return None
+        return pd.DataFrame(decode_term_vector(self.term_vector), index=[str(self._id), ])
@@ -0,0 +1,50 @@
+from bson.objectid import ObjectId
+
+# The only fields read from the database to show a document to the client
+CLIENT_PROJECTION = {'clinical_id': 1, 'title': 1, 'url': 1, 'description': 1}
+
+
+class DocumentView:
+    """
+    A read-only view of the client facing fields of a document, built from a database record fetched with
+    CLIENT_PROJECTION. Unlike Document it only holds the five fields needed for a search result, in __slots__, so
+    hydrating a page of results allocates a handful of small objects.
+
+    Attributes
+
+    _id: ObjectId | str | None - database id for the document
+
+    clinical_id: str | None - the clinical id given to the document by trec
+
+    title: str | None - title of the document
+
+    url: str - url for the document
+
+    description: str | None - a brief description of the document for client / ui display
+
+    Methods
+
+    info_client: dict - return the class variables relevant for client / ui, as Document.info_client does
+
+    """
+    __slots__ = ('_id', 'clinical_id', 'title', 'url', 'description')
+
+    def __init__(self, doc: dict):
+        self._id: ObjectId | str | None = doc.get('_id')
+        self.clinical_id: str | None = doc.get('clinical_id')
+        self.title: str | None = doc.get('title')
+        self.url: str = doc.get('url', "")
+        self.description: str | None = doc.get('description')
+
+    def info_client(self):
+        """
+        Return all class variables relevant for client / ui
+
+        :return: dict
+        """
+        return {
+            "_id": str(self._id),
+            "title": self.title,
+            "url": self.url,
+            "description": self.description
+        }
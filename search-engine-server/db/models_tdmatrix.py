@@ -1,25 +1,63 @@
 from bson.objectid import ObjectId
+import json
+import numpy as np
 import pandas as pd
 from pandas.core.frame import DataFrame
+from scipy.sparse import csr_matrix, vstack
 import os
-import pickle
+import shutil
+
+# Number of segments kept on disk before save_matrix merges them into one
+MAX_SEGMENTS = 32
+MANIFEST = 'manifest.json'
 
 
 class TermDocumentMatrix:
     """
     A term document matrix for all documents in the corpus.
 
+    The matrix has one row per document and one column per term. It is saved in a directory as a list of segments,
+    each segment holding the CSR arrays (indptr, indices, data) of a batch of documents, their ids and the terms first
+    seen in that batch, as separate .npy files. Segments are opened with np.load(mmap_mode='r'), so loading is almost
+    instant and processes opening the same matrix share the pages. Saving only writes the documents added since the
+    last save as a new segment.
+
+    Documents added since the last save are kept in growable coordinate (row, column, count) arrays, so appending a
+    batch of documents only touches the new entries (amortised O(nnz)).
+
     Attributes
 
     _id: ObjectId | None - database id for the document
     corpus_name: str | None - name of the corpus
-    matrix: DataFrame | str | None - a pandas dataframe representation of document-term-frequencies
+    directory: str | None - directory the matrix is saved in, defaults to <corpus_name>.tdm in the working directory
+    segments: list - the saved segments, as dicts of memory-mapped arrays
+    saved_terms: int - number of terms in the saved segments
+    vocabulary: dict | None - column index of each term, built the first time a document is added
+    pending_terms: list - terms first seen since the last save
+    pending_doc_ids: list - ids of the documents added since the last save
+    rows: ndarray - row index (within the pending documents) of each pending count
+    cols: ndarray - column index of each pending count
+    counts: ndarray - pending term frequencies
+    nnz: int - number of pending counts, the arrays above may have spare capacity after it
+    csr: csr_matrix | None - the matrix built from the segments and pending arrays, None until requested
 
     Methods
 
     info: dict - return all class variables as a dictionary
 
-    save_matrix: bool - saves the term document matrix for the corpus as a pickle file.
+    matrix: csr_matrix - the documents x terms frequency matrix
+
+    terms: list - term of each column
+
+    doc_ids: list - document id of each row
+
+    load_matrix: bool - opens the saved segments, returns False if the matrix has not been saved yet
+
+    save_matrix: bool - writes the documents added since the last save as a new segment.
+
+    compact: bool - merges all segments into a single one.
+
+    add_documents: bool - adds a batch of documents (term frequency dicts) to the term-document matrix.
 
     add_new_document: bool - adds a new document (df) to the term-document matrix.
 
@@ -27,14 +65,24 @@ class TermDocumentMatrix:
     def __init__(self, doc: dict | None = None):
         self._id: ObjectId | str | None = None
         self.corpus_name: str | None = None
-        self.matrix: DataFrame | str | None = pd.DataFrame()
+        self.directory: str | None = None
+        self.segments: list = list()
+        self.saved_terms: int = 0
+        self.vocabulary: dict | None = None
+        self.pending_terms: list = list()
+        self.pending_doc_ids: list = list()
+        self.rows: np.ndarray = np.zeros(0, dtype=np.int32)
+        self.cols: np.ndarray = np.zeros(0, dtype=np.int32)
+        self.counts: np.ndarray = np.zeros(0, dtype=np.float32)
+        self.nnz: int = 0
+        self.csr: csr_matrix | None = None
 
         # If document exists assign each value pair to the respective value pair for class instance
         if doc:
             for k, v in doc.items():
                 setattr(self, k, v)
-            if 'matrix' in doc.keys() and type(doc['matrix']) == str:
-                self.matrix = pd.read_json(doc['matrix'])
+        if self.directory is None and self.corpus_name is not None:
+            self.directory = os.path.join(os.getcwd(), f'{self.corpus_name}.tdm')
 
     def info(self):
         """
@@ -48,33 +96,269 @@ class TermDocumentMatrix:
             "matrix": self.matrix
         }
 
+    @property
+    def terms(self):
+        """
+        Term of each column.
+
+        :return: list
+        """
+        saved = [str(term) for segment in self.segments for term in segment['terms']]
+        return saved + self.pending_terms
+
+    @property
+    def doc_ids(self):
+        """
+        Document id of each row.
+
+        :return: list
+        """
+        saved = [str(doc_id) for segment in self.segments for doc_id in segment['doc_ids']]
+        return saved + self.pending_doc_ids
+
+    @property
+    def matrix(self):
+        """
+        The documents x terms frequency matrix in CSR format. With a single saved segment and nothing pending, the
+        matrix is built on the memory-mapped arrays without copying them.
+
+        :return: csr_matrix
+        """
+        if self.csr is None:
+            n_terms = self.saved_terms + len(self.pending_terms)
+            blocks = [csr_matrix((segment['data'], segment['indices'], segment['indptr']),
+                                 shape=(len(segment['doc_ids']), n_terms), copy=False) for segment in self.segments]
+            if self.pending_doc_ids:
+                blocks.append(self.pending_matrix(n_terms))
+            if not blocks:
+                self.csr = csr_matrix((0, n_terms), dtype=np.float32)
+            elif len(blocks) == 1:
+                self.csr = blocks[0]
+            else:
+                self.csr = vstack(blocks, format='csr')
+        return self.csr
+
+    def pending_matrix(self, n_terms: int):
+        """
+        Returns the documents added since the last save as a CSR matrix with n_terms columns.
+
+        :param n_terms: int
+        :return: csr_matrix
+        """
+        return csr_matrix((self.counts[:self.nnz], (self.rows[:self.nnz], self.cols[:self.nnz])),
+                          shape=(len(self.pending_doc_ids), n_terms))
+
+    def reserve(self, extra: int):
+        """
+        Makes room for extra more pending counts, doubling the capacity of the coordinate arrays when they are full.
+
+        :param extra: int
+        :return: None
+        """
+        needed = self.nnz + extra
+        if needed <= len(self.counts):
+            return
+        capacity = max(needed, 2 * len(self.counts), 1024)
+        for name in ('rows', 'cols', 'counts'):
+            grown = np.zeros(capacity, dtype=getattr(self, name).dtype)
+            grown[:self.nnz] = getattr(self, name)[:self.nnz]
+            setattr(self, name, grown)
+
+    def load_matrix(self):
+        """
+        Opens the saved segments of the matrix as memory-mapped arrays. Returns False if the matrix has not been saved
+        yet.
+
+        :return: bool
+        """
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        if not os.path.isfile(manifest_path):
+            return False
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        self.segments = [self.open_segment(name) for name in manifest['segments']]
+        self.saved_terms = manifest['n_terms']
+        self.vocabulary = None
+        self.csr = None
+        return True
+
+    def open_segment(self, name: str):
+        """
+        Opens the arrays of a saved segment as memory-mapped arrays.
+
+        :param name: str
+        :return: dict
+        """
+        path = os.path.join(self.directory, name)
+        segment = {'name': name}
+        for array in ('indptr', 'indices', 'data', 'doc_ids'):
+            segment[array] = np.load(os.path.join(path, f'{array}.npy'), mmap_mode='r')
+        if os.path.isfile(os.path.join(path, 'terms.json')):
+            with open(os.path.join(path, 'terms.json'), 'r') as f:
+                segment['terms'] = json.load(f)
+        else:
+            segment['terms'] = np.load(os.path.join(path, 'terms.npy'), mmap_mode='r')  # segments of earlier versions
+        return segment
+
+    def write_segment(self, name: str, matrix: csr_matrix, doc_ids: list, terms: list):
+        """
+        Writes the arrays of a segment to disk.
+
+        :param name: str
+        :param matrix: csr_matrix
+        :param doc_ids: list
+        :param terms: list
+        :return: None
+        """
+        path = os.path.join(self.directory, name)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'indptr.npy'), matrix.indptr.astype(np.int64))
+        np.save(os.path.join(path, 'indices.npy'), matrix.indices.astype(np.int32))
+        np.save(os.path.join(path, 'data.npy'), matrix.data.astype(np.float32))
+        # Document ids all have the same length, so they are kept in a fixed width unicode array that can be
+        # memory-mapped. Terms are not: one long token would make every slot of a fixed width array that wide.
+        np.save(os.path.join(path, 'doc_ids.npy'), np.array(doc_ids, dtype=str))
+        with open(os.path.join(path, 'terms.json'), 'w') as f:
+            json.dump(list(terms), f)
+
+    def write_manifest(self, segment_names: list, n_terms: int):
+        """
+        Replaces the manifest listing the segments of the matrix. The file is replaced atomically, so a reader never
+        sees a partially written manifest.
+
+        :param segment_names: list
+        :param n_terms: int
+        :return: None
+        """
+        tmp_path = os.path.join(self.directory, f'{MANIFEST}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'corpus_name': self.corpus_name, 'segments': segment_names, 'n_terms': n_terms}, f)
+        os.replace(tmp_path, os.path.join(self.directory, MANIFEST))
+
+    def next_segment_name(self):
+        """
+        Returns the name of the next segment to write.
+
+        :return: str
+        """
+        last = int(self.segments[-1]['name'].split('-')[-1]) if self.segments else -1
+        return f'segment-{last + 1:05d}'
+
+    def write_pending(self):
+        """
+        Writes the documents added since the last save as a new segment and adds it to the manifest.
+
+        :return: None
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        n_terms = self.saved_terms + len(self.pending_terms)
+        names = [segment['name'] for segment in self.segments]
+        if self.pending_doc_ids:
+            name = self.next_segment_name()
+            self.write_segment(name, self.pending_matrix(n_terms), self.pending_doc_ids, self.pending_terms)
+            names.append(name)
+        self.write_manifest(names, n_terms)
+        if self.pending_doc_ids:
+            self.segments.append(self.open_segment(names[-1]))
+        self.saved_terms = n_terms
+        self.pending_terms = list()
+        self.pending_doc_ids = list()
+        self.nnz = 0
+        self.csr = None
+
     def save_matrix(self):
         """
-        Saves the term document matrix for the corpus as a pickle file.
+        Writes the documents added since the last save as a new segment. Merges the segments into one when there are
+        more than MAX_SEGMENTS of them.
 
         :return: bool
         """
         try:
-            path = os.path.join(os.getcwd(), f'{self.corpus_name}.pkl')
-            with open(path, 'wb') as f:
-                pickle.dump(self, f)
+            self.write_pending()
+            if len(self.segments) > MAX_SEGMENTS:
+                return self.compact()
             return True
         except Exception as e:
             print('Error:', e)
             return False
 
-    def add_new_document(self, df: DataFrame):
+    def compact(self):
         """
-        Adds a new document (df) to the term-document matrix.
+        Merges all saved segments into a single one and removes the old segments. Documents added since the last save
+        are saved first.
 
-        :param df: DataFrame
         :return: bool
         """
         try:
-            self.matrix = pd.concat([self.matrix, df], join='outer')
-            self.matrix = self.matrix.fillna(0.0)
-            self.save_matrix()
+            if self.pending_doc_ids:
+                self.write_pending()
+            if len(self.segments) <= 1:
+                return True
+            old_names = [segment['name'] for segment in self.segments]
+            name = self.next_segment_name()
+            self.write_segment(name, self.matrix, self.doc_ids, self.terms)
+            self.write_manifest([name], self.saved_terms)
+            self.segments = [self.open_segment(name)]
+            self.csr = None
+            for old_name in old_names:
+                shutil.rmtree(os.path.join(self.directory, old_name), ignore_errors=True)
             return True
         except Exception as e:
-            print(f'Error: failed to add new document to matrix', e)
+            print('Error: failed to compact matrix', e)
             return False
+
+    def add_documents(self, doc_ids: list, term_frequencies: list):
+        """
+        Adds a batch of documents to the term-document matrix. term_frequencies holds one {term: count} dictionary per
+        document id. Does not save the matrix, call save_matrix once the batches have been added.
+
+        :param doc_ids: list
+        :param term_frequencies: list
+        :return: bool
+        """
+        if self.vocabulary is None:
+            self.vocabulary = {term: col for col, term in enumerate(self.terms)}
+        first_row = len(self.pending_doc_ids)
+        try:
+            extra = sum(len(tf) for tf in term_frequencies)
+            self.reserve(extra)
+            position = self.nnz
+            for doc_id, tf in zip(doc_ids, term_frequencies):
+                row = len(self.pending_doc_ids)
+                self.pending_doc_ids.append(doc_id)
+                for term, count in tf.items():
+                    col = self.vocabulary.get(term)
+                    if col is None:
+                        col = self.saved_terms + len(self.pending_terms)
+                        self.vocabulary[term] = col
+                        self.pending_terms.append(term)
+                    self.rows[position] = row
+                    self.cols[position] = col
+                    self.counts[position] = count
+                    position += 1
+            self.nnz = position
+            self.csr = None
+            return True
+        except Exception as e:
+            del self.pending_doc_ids[first_row:]  # counts past self.nnz are ignored, so only the rows need rolling back
+            print('Error: failed to add documents to matrix', e)
+            return False
+
+    def add_new_document(self, df: DataFrame | dict):
+        """
+        Adds a new document (df) to the term-document matrix and saves it. df is either a one row DataFrame indexed by
+        the document id with a column per term, or a {document id: {term: count}} dictionary.
+
+        :param df: DataFrame | dict
+        :return: bool
+        """
+        if type(df) == DataFrame:
+            doc_ids = [str(i) for i in df.index]
+            term_frequencies = [{term: count for term, count in row.items() if pd.notna(count) and count}
+                                for _, row in df.iterrows()]
+        else:
+            doc_ids = [str(i) for i in df.keys()]
+            term_frequencies = list(df.values())
+        if self.add_documents(doc_ids, term_frequencies):
+            return self.save_matrix()
+        return False
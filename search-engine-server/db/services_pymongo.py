@@ -9,6 +9,9 @@ db = client.ir_group_21_clinical
 # Connect to specific collection in database
 documents = db.documents
 queries = db.queries
+index_queue = db.index_queue  # clinical ids of ingested documents not yet merged into the Terrier indexes
+vocabulary = db.vocabulary  # integer id of every term, used by the document term vectors
+counters = db.counters
 
 
 def create_index(collection, attribute):
@@ -20,6 +23,9 @@ def create_all_indexes():
     create_index(documents, 'url')
     create_index(queries, 'topic_number')
     create_index(queries, 'content')
+    create_index(index_queue, 'clinical_id')
+    create_index(vocabulary, 'term')
+    create_index(vocabulary, 'term_id')
 
 
 create_all_indexes()
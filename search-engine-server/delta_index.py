@@ -0,0 +1,275 @@
+from functools import partial
+import asyncio
+import glob
+import os
+import shutil
+import time
+import pyterrier as pt
+from db import get_queued_documents, remove_queued_documents, get_documents_for_indexing_cursor
+from db import get_documents_for_snippets
+from preprocessing import preprocess_documents
+from retrieval_custom_preprocess import WARM_CONFIGS, control_documents
+from retrieval_custom_preprocess import retriever_registry, snippet_stores, delta_snippet_stores
+from retrieval_custom_preprocess import lexicon_tables, load_lexicon_table
+from retrievers import index_version, concurrent_index, CUSTOM_INDEX_DIR, CONTROL_INDEX_DIR
+from snippet_store import SnippetStore, SNIPPET_DATA, SNIPPET_OFFSETS, SNIPPET_DOCNOS
+import startup
+
+''' Incremental indexing: documents added by process_clinical_trial are searched through a small delta index next to
+each main index, and merged into the main index in the background '''
+
+# Seconds between two checks of the indexing queue, number of queued documents that triggers a merge, and maximum age
+# in seconds of a delta index before it is merged whatever its size
+DELTA_POLL_INTERVAL = float(os.environ.get('DELTA_POLL_INTERVAL', 60))
+DELTA_MERGE_DOCS = int(os.environ.get('DELTA_MERGE_DOCS', 1000))
+DELTA_MERGE_INTERVAL = float(os.environ.get('DELTA_MERGE_INTERVAL', 3600))
+
+INDEX_DIRS = {'custom': CUSTOM_INDEX_DIR, 'control': CONTROL_INDEX_DIR}
+
+# Turns a cursor over (clinical_id, raw_text) into the {'docno', 'text'} dicts of each index, as the full build does.
+# Deltas are small, so the custom documents are preprocessed in this process rather than in a pool.
+DOCUMENT_BUILDERS = {'custom': partial(preprocess_documents, processes=1), 'control': control_documents}
+
+# Main index of each name, the delta index currently searched with it, and the indexes they replaced, closed one round
+# later
+base_indexes = dict()
+delta_indexes = dict()
+retired_indexes = dict()
+delta_state = {
+    "docnos": dict(),  # index name -> docnos in the current delta index
+    "dirs": dict(),  # index name -> directory of the current delta index
+    "since": None,  # time the oldest document of the current deltas was indexed
+    "merges": 0,
+}
+
+
+def open_index(index_dir: str):
+    """
+    Opens the Terrier index saved in index_dir, safe for concurrent retrieval so that it can be part of a MultiIndex
+    shared by the scoring threads.
+
+    :param index_dir: str
+    :return: Index
+    """
+    return concurrent_index(pt.IndexFactory.of(os.path.join(os.path.abspath(index_dir), "data.properties")))
+
+
+def remove_stale_deltas(base_dir: str, keep: tuple = ()):
+    """
+    Removes the delta index directories of a main index, except the ones in keep.
+
+    :param base_dir: str
+    :param keep: tuple
+    :return: None
+    """
+    for delta_dir in glob.glob(f"{base_dir}.delta-*"):
+        if delta_dir not in keep:
+            shutil.rmtree(delta_dir, ignore_errors=True)
+
+
+def build_delta(name: str, base_dir: str, docnos: list):
+    """
+    Indexes the documents with the given clinical ids into a new delta directory next to the main index, with a snippet
+    store for them, and returns the directory. The delta holds every document that is not merged yet, so it replaces
+    the previous delta rather than adding to it.
+
+    :param name: str
+    :param base_dir: str
+    :param docnos: list
+    :return: str
+    """
+    delta_dir = f"{base_dir}.delta-{time.time_ns()}"
+    docs = DOCUMENT_BUILDERS[name](get_documents_for_indexing_cursor(ids=docnos))
+    pt.IterDictIndexer(delta_dir, stopwords=None, threads=1).index(docs)
+    SnippetStore(delta_dir).build(get_documents_for_snippets(docnos))
+    return delta_dir
+
+
+def merge_index(base_dir: str, delta_dir: str, docnos: list):
+    """
+    Merges the delta index into the main index with Terrier's StructureMerger, extends the snippet store of the main
+    index with the delta documents, and swaps the merged index in place of the main index directory. The previous main
+    index is kept as <base_dir>.old until the next merge, so that searches still running on it are not affected.
+
+    :param base_dir: str
+    :param delta_dir: str
+    :param docnos: list
+    :return: None
+    """
+    merged_dir = f"{base_dir}.merged"
+    previous_dir = f"{base_dir}.old"
+    shutil.rmtree(merged_dir, ignore_errors=True)
+    os.makedirs(merged_dir)
+
+    index_on_disk = pt.autoclass("org.terrier.structures.IndexOnDisk")
+    structure_merger = pt.autoclass("org.terrier.structures.merging.StructureMerger")
+    base = index_on_disk.createIndex(os.path.abspath(base_dir), "data")
+    delta = index_on_disk.createIndex(os.path.abspath(delta_dir), "data")
+    merged = index_on_disk.createNewIndex(os.path.abspath(merged_dir), "data")
+    structure_merger(base, delta, merged).mergeStructures()
+    merged.close()
+    delta.close()
+    base.close()
+
+    for name in (SNIPPET_DATA, SNIPPET_OFFSETS, SNIPPET_DOCNOS):
+        shutil.copy(os.path.join(base_dir, name), merged_dir)
+    SnippetStore(merged_dir).append(get_documents_for_snippets(docnos))
+
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    os.rename(base_dir, previous_dir)
+    os.rename(merged_dir, base_dir)  # restore_index_dir() puts the previous index back if this step never runs
+
+
+def retire(name: str, indexes: list):
+    """
+    Closes the Terrier indexes of a name replaced in the previous round, and keeps the ones replaced now open one more
+    round for the searches that may still be running on them, as the previous delta directories are kept.
+
+    :param name: str
+    :param indexes: list
+    :return: None
+    """
+    for index in retired_indexes.pop(name, []):
+        try:
+            index.close()
+        except Exception as e:
+            print('Error: failed to close a replaced index', e)
+    retired_indexes[name] = [index for index in indexes if index is not None]
+
+
+def register(name: str, previous_base=None):
+    """
+    Registers the main index of a name, combined with its current delta index if there is one, so that new searches
+    see the delta documents. Replacing the index drops the cached results of the previous one. The previous delta index
+    and previous_base, the main index replaced by a merge, are retired (see retire). Opens indexes and warms the
+    retrievers, so it runs in a worker thread.
+
+    :param name: str
+    :param previous_base: Index | None
+    :return: None
+    """
+    base_dir = INDEX_DIRS[name]
+    if name not in base_indexes:
+        # the main index registered at startup, rather than a second copy of it
+        base_indexes[name] = retriever_registry.indexes.get(name)
+        if base_indexes[name] is None:
+            base_indexes[name] = open_index(base_dir)
+    delta_dir = delta_state["dirs"].get(name)
+    previous_delta = delta_indexes.pop(name, None)
+    if delta_dir is None:
+        index = base_indexes[name]
+        version = index_version(base_dir)
+    else:
+        delta_indexes[name] = open_index(delta_dir)
+        index = base_indexes[name] + delta_indexes[name]  # MultiIndex over the main and delta index
+        version = f"{index_version(base_dir)}+{os.path.basename(delta_dir)}"
+    retriever_registry.register_index(name, index, version)
+    retriever_registry.warm(WARM_CONFIGS)
+    retire(name, [previous_delta, previous_base])
+
+
+async def refresh_deltas(queued: list):
+    """
+    Rebuilds the delta index of every name from the queued documents that are not in its main index yet, and
+    registers it. Nothing is rebuilt if the delta documents did not change.
+
+    :param queued: list
+    :return: None
+    """
+    for name, base_dir in INDEX_DIRS.items():
+        docnos = [docno for docno in queued if docno not in snippet_stores[name].rows]
+        if docnos == delta_state["docnos"].get(name, []):
+            continue
+        previous_dir = delta_state["dirs"].get(name)
+        if docnos:
+            delta_dir = await asyncio.to_thread(build_delta, name, base_dir, docnos)
+            store = SnippetStore(delta_dir)
+            await asyncio.to_thread(store.load)
+            delta_state["dirs"][name] = delta_dir
+            delta_snippet_stores[name] = store
+        else:
+            delta_state["dirs"].pop(name, None)
+            delta_snippet_stores.pop(name, None)
+        delta_state["docnos"][name] = docnos
+        await asyncio.to_thread(register, name)
+        # The previous delta is kept one more round for the searches that may still be running on it
+        remove_stale_deltas(base_dir, keep=(delta_state["dirs"].get(name), previous_dir))
+        print(f"{name} delta index: {len(docnos)} documents")
+    if delta_state["since"] is None and any(delta_state["docnos"].values()):
+        delta_state["since"] = time.time()
+
+
+async def merge_deltas():
+    """
+    Merges every delta index into its main index, registers the merged indexes, refreshes their lexicon tables and
+    removes the merged documents from the indexing queue.
+
+    :return: None
+    """
+    merged = set()
+    for name, base_dir in INDEX_DIRS.items():
+        delta_dir = delta_state["dirs"].get(name)
+        if delta_dir is None:
+            continue
+        docnos = delta_state["docnos"][name]
+        start = time.perf_counter()
+        await asyncio.to_thread(merge_index, base_dir, delta_dir, docnos)
+        store = SnippetStore(base_dir)
+        await asyncio.to_thread(store.load)
+        previous_base = base_indexes.get(name)
+        base_indexes[name] = await asyncio.to_thread(open_index, base_dir)
+        snippet_stores[name] = store
+        lexicon_tables[name] = await asyncio.to_thread(load_lexicon_table, base_dir)
+        delta_state["dirs"].pop(name)
+        delta_state["docnos"][name] = []
+        delta_snippet_stores.pop(name, None)
+        await asyncio.to_thread(register, name, previous_base)
+        merged.update(docnos)
+        print(f"Merged {len(docnos)} documents into {base_dir} in {time.perf_counter() - start:.1f}s")
+    delta_state["since"] = None
+    delta_state["merges"] += 1
+    if merged:
+        await asyncio.to_thread(remove_queued_documents, list(merged))
+
+
+async def update_indexes():
+    """
+    Indexes the queued documents in the delta indexes and merges the deltas once they hold DELTA_MERGE_DOCS documents
+    or are older than DELTA_MERGE_INTERVAL seconds.
+
+    :return: None
+    """
+    queued = await asyncio.to_thread(get_queued_documents)
+    await refresh_deltas(queued)
+
+    if not any(delta_state["docnos"].values()):
+        # Every queued document is already in the main indexes, e.g. because they were rebuilt
+        delta_state["since"] = None
+        if queued:
+            await asyncio.to_thread(remove_queued_documents, queued)
+        return
+
+    size = max(len(docnos) for docnos in delta_state["docnos"].values())
+    if size >= DELTA_MERGE_DOCS or time.time() - delta_state["since"] >= DELTA_MERGE_INTERVAL:
+        await merge_deltas()
+
+
+async def run():
+    """
+    Keeps the indexes up to date with the indexing queue once the server is ready. Meant to run as a background task.
+
+    :return: None
+    """
+    while not startup.state["ready"]:
+        if not startup.state["live"]:
+            return
+        await asyncio.sleep(1)
+
+    for base_dir in INDEX_DIRS.values():
+        remove_stale_deltas(base_dir)
+    while True:
+        try:
+            await update_indexes()
+        except Exception as e:
+            print('Error: failed to update the delta indexes:', e)
+        await asyncio.sleep(DELTA_POLL_INTERVAL)
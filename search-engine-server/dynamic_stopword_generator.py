@@ -1,32 +1,31 @@
 import numpy as np
-import random
+import pandas as pd
+import itertools
 import csv
-from db.services_pymongo import documents
 from scipy.sparse import csr_matrix
-from tqdm import tqdm
 
 '''
 Implementation of the dynamic stopwords list. A csv file will be generated
 
-WARNING: When using a large number of documents, this script has a long runtime.
-This is due to the function scipy.sparse.csr_matrix.
-With n_docs = 500 it runs in ~6 minutes.
-With n_docs = 5000 it runs in ~1 hour.
+Run this file as standalone to generate the list. The functions can be imported without touching the database.
 '''
 
 
-# Generate a random sample of n_docs documents from the database.
-n_docs = 5000
-docs = random.sample(list(documents.find({}, {"_id": 0, "tf_text": 1})), n_docs)
-tf_text_list = [list(tf_text_dict.values())[0] for tf_text_dict in docs]
-
-# docs_list, doc_lens and tokens_list are the derived objects from which the stopword list will be built.
-docs_list = list()
-for tf_text in tf_text_list:
-    docs_list.append(tf_text.split())
+def iter_docs_batches(batch_size: int = 5000):
+    """
+    Yields every document in the database in batches of batch_size, each document as a list of tokens.
+    Only one batch of documents is held in memory at a time.
+    """
+    from db.services_pymongo import documents
 
-doc_lens = [len(doc) for doc in docs_list]
-tokens_list = [token for doc in docs_list for token in doc]
+    batch = list()
+    for doc in documents.find({}, {"_id": 0, "tf_text": 1}).batch_size(batch_size):
+        batch.append((doc.get('tf_text') or '').split())
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
 
 
 # CREATE A DOCUMENT-TERM MATRIX
@@ -41,33 +40,76 @@ def csr_doc_term_matrix(list_docs):
     - doc_term_matrix : A collection of (<term_id>, <document_id>) <frequency>
         For an entry '(i,j) frequency' frequency is the number of occurrences of term i in document j.
     - dict_term_id : a mapping of vocabulary terms to indices id=0,...,V-1
-    """
 
-    # Alphabetical vocab set and dictionary to store term ids
-    vocab_set = set(tokens_list)
-    vocab_sorted = sorted(list(vocab_set))
-    V = len(vocab_sorted)
-    dict_term_id = dict(zip(vocab_sorted, range(V)))
+    The matrix is built without a per-token Python loop: pd.factorize maps every token to an id in one pass (over
+    Python strings, never a fixed width string array, which would be as wide as the longest token for every token),
+    only the vocabulary is sorted alphabetically, and the document id of every token is expanded from the document
+    lengths.
+    """
 
     D = len(list_docs)
+    doc_lens = np.fromiter((len(doc) for doc in list_docs), dtype=np.int64, count=D)
+    tokens = np.fromiter(itertools.chain.from_iterable(list_docs), dtype=object, count=int(doc_lens.sum()))
+    codes, vocab = pd.factorize(tokens)
 
-    # Forming the csr_matrix function arguments
-    rows = []
-    cols = []
-    data = []
+    # Alphabetical vocabulary and the term id of every token
+    V = len(vocab)
+    order = np.argsort(vocab)
+    rank = np.empty(V, dtype=np.int64)
+    rank[order] = np.arange(V)
+    rows = rank[codes]
+    dict_term_id = dict(zip(vocab[order].tolist(), range(V)))
 
-    for i_doc in tqdm(range(D)):
-        doc = list_docs[i_doc]
-        data = data + [1] * len(doc)
-        cols = cols + [i_doc] * len(doc)
-        rows = rows + [dict_term_id[h] for h in doc]
+    # Document id of every token
+    cols = np.repeat(np.arange(D), doc_lens)
+    data = np.ones(len(codes), dtype=np.int64)
 
-    doc_term_matrix = csr_matrix((data, (rows, cols)), shape=(V, D), dtype=np.int64, copy=False)
+    # Duplicate (term, document) pairs are summed into frequencies
+    doc_term_matrix = csr_matrix((data, (rows, cols)), shape=(V, D), dtype=np.int64)
 
     return doc_term_matrix, dict_term_id
 
 
-doc_term_matrix, dict_term_id = csr_doc_term_matrix(docs_list)
+def stream_doc_term_matrix(doc_batches):
+    """
+    Makes the same sparse document-term matrix as csr_doc_term_matrix from an iterable of batches of documents, so
+    that the whole corpus never has to be held as a list of tokens.
+    INPUT: doc_batches - iterable of lists of documents, each document a list of tokens (strings).
+
+    OUTPUTS:
+    - doc_term_matrix : term x document frequency matrix, terms in alphabetical order
+    - dict_term_id : a mapping of vocabulary terms to indices id=0,...,V-1
+    - doc_lens : numpy array of the number of tokens in each document
+    """
+
+    vocab = dict()  # term -> id in order of first appearance
+    rows, cols, data, doc_lens = [], [], [], []
+    n_docs = 0
+
+    for batch in doc_batches:
+        batch_matrix, batch_term_id = csr_doc_term_matrix(batch)
+        # Only the batch vocabulary goes through Python, the counts are remapped with numpy
+        global_ids = np.fromiter((vocab.setdefault(term, len(vocab)) for term in batch_term_id),
+                                 dtype=np.int64, count=len(batch_term_id))
+        coo = batch_matrix.tocoo()
+        rows.append(global_ids[coo.row])
+        cols.append(coo.col + n_docs)
+        data.append(coo.data)
+        doc_lens.append(np.fromiter((len(doc) for doc in batch), dtype=np.int64, count=len(batch)))
+        n_docs += len(batch)
+
+    # Renumber the terms alphabetically, as in csr_doc_term_matrix
+    terms = np.array(list(vocab), dtype=object)  # Python strings, see csr_doc_term_matrix
+    order = np.argsort(terms)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    dict_term_id = dict(zip(terms[order].tolist(), range(len(order))))
+
+    if rows:
+        rows, cols, data = rank[np.concatenate(rows)], np.concatenate(cols), np.concatenate(data)
+    doc_term_matrix = csr_matrix((data, (rows, cols)), shape=(len(order), n_docs), dtype=np.int64)
+
+    return doc_term_matrix, dict_term_id, np.concatenate(doc_lens) if doc_lens else np.zeros(0, dtype=np.int64)
 
 # CALCULATE CONDITIONAL ENTROPY OF TERMS GIVEN A COLLECTION
 
@@ -112,63 +154,60 @@ def conditional_entropy_csr(sparse_matrix):
     return H_vector
 
 
-H_vector = conditional_entropy_csr(doc_term_matrix)
-
-
-# COMPARISON WITH AVERAGE NULL MODEL
-
-
-def shuffle_terms(doc_lens, tokens_list):
-    """
-    Shuffles tokens and redistributes them over the documents
-    Returns a new document list with the terms shuffled
-    Document lengths are preserved but terms are permuted across the entire collection
-    """
-
-    null_tokens = list(np.random.permutation(tokens_list))
-    null_documents = list()
-    start = 0
-
-    for i in doc_lens:
-        null_documents.append(null_tokens[start:start + i])
-        start += i
+# COMPARISON WITH THE EXPECTED NULL MODEL
 
-    return null_documents
 
-
-null_docs = shuffle_terms(doc_lens, tokens_list)
-
-
-def null_model_generator(doc_lens, tokens_list):
+def expected_null_entropy(term_freq, doc_lens, exact_below=30.0):
     """
-    Generates one iteration of the null model as follows:
-    - Shuffles the tokens across the documents
-    - Creates document-term matrix
-    - Calculates the conditional entropy
-    - Returns numpy array of conditional entropies
+    Expected conditional entropy of each term when the tokens of the collection are shuffled across the documents,
+    computed from the term frequencies and document lengths only, without generating shuffled collections.
+
+    Under shuffling, the count n of a term with collection frequency f in a document of length L is (almost exactly,
+    since L is tiny next to the number of tokens N) Binomial(f, L / N), so
+        E[H] = log2(f) - 1/f * sum over documents of E[n log2 n].
+    E[n log2 n] is summed exactly over the binomial probabilities while the mean f * L / N is below exact_below, and
+    with the second order approximation mu log2 mu + var / (2 mu ln 2) above it. Terms with the same frequency and
+    documents with the same length share the computation.
+
+    INPUT: term_freq - collection frequency of each term, doc_lens - number of tokens in each document
+    OUTPUT: numpy array of expected conditional entropies, in the order of term_freq
     """
 
-    null_matrix, dict_term_id = csr_doc_term_matrix(shuffle_terms(doc_lens, tokens_list))
+    term_freq = np.asarray(term_freq)
+    doc_lens = np.asarray(doc_lens)
+    n_tokens = doc_lens.sum()
 
-    return conditional_entropy_csr(null_matrix)
+    lengths, length_counts = np.unique(doc_lens[doc_lens > 0], return_counts=True)
+    p = np.minimum(lengths / n_tokens, 1 - 1e-12)
+    freqs, inverse = np.unique(term_freq, return_inverse=True)
+    expected_sum = np.zeros(len(freqs))
 
+    for i, f in enumerate(freqs):
+        if f < 2:
+            continue  # n log2 n is 0 for n = 0 and n = 1
+        mu = f * p
+        var = mu * (1 - p)
+        large = mu >= exact_below
+        total = 0.0
 
-def null_model_iterator(n, doc_lens, tokens_list):
-    """
-    Iterates null_model_generator n times and takes the mean of the resulting H_vectors
-    """
-
-    null_sum = null_model_generator(doc_lens, tokens_list)
-
-    for i in range(n-1):
-        null_sum += null_model_generator(doc_lens, tokens_list)
-
-    return null_sum/n
+        if large.any():
+            m = mu[large]
+            total += np.sum(length_counts[large] * (m * np.log2(m) + var[large] / (2 * m * np.log(2))))
 
+        small = ~large
+        if small.any():
+            ps = p[small]
+            # Binomial probabilities of 1..K occurrences via P(k + 1) = P(k) * (f - k) / (k + 1) * p / (1 - p)
+            K = int(min(f, np.ceil(mu[small].max() + 12 * np.sqrt(var[small].max()) + 12)))
+            k = np.arange(K)
+            ratio = ((f - k) / (k + 1))[None, :] * (ps / (1 - ps))[:, None]
+            P = np.exp(f * np.log1p(-ps))[:, None] * np.cumprod(ratio, axis=1)
+            ks = np.arange(1, K + 1)
+            total += np.sum(length_counts[small] * (P @ (ks * np.log2(ks))))
 
-H_null_mean = null_model_iterator(10, doc_lens, tokens_list)
+        expected_sum[i] = total
 
-info_content = H_null_mean - H_vector
+    return (np.log2(freqs) - expected_sum / freqs)[inverse]
 
 
 def get_stopword_list(threshold, info_content, dict_term_id):
@@ -178,7 +217,7 @@ def get_stopword_list(threshold, info_content, dict_term_id):
     Overwrites an existing csv of the same name if function has been previously called.
     """
 
-    inferred_stopword_indices = np.where(np.abs(info_content) < threshold)[0]
+    inferred_stopword_indices = set(np.where(np.abs(info_content) < threshold)[0].tolist())
 
     inferred_stopword_list = list()
 
@@ -194,4 +233,16 @@ def get_stopword_list(threshold, info_content, dict_term_id):
     return
 
 
-get_stopword_list(0.1, info_content, dict_term_id)
+# Run this file as standalone to generate inferred_stopwords.csv
+if __name__ == '__main__':
+    # The document-term matrix and document lengths of the whole corpus are the objects from which the stopword list
+    # will be built.
+    doc_term_matrix, dict_term_id, doc_lens = stream_doc_term_matrix(iter_docs_batches())
+    H_vector = conditional_entropy_csr(doc_term_matrix)
+
+    term_freq = np.array(doc_term_matrix.sum(axis=1)).ravel()
+    H_null_mean = expected_null_entropy(term_freq, doc_lens)
+
+    info_content = H_null_mean - H_vector
+
+    get_stopword_list(0.1, info_content, dict_term_id)
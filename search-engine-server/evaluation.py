@@ -1,8 +1,16 @@
-from retrieval_custom_preprocess import evaluate
+from evaluation_runner import evaluate
+from retrievers import init_terrier, restore_index_dir, CUSTOM_INDEX_DIR, CONTROL_INDEX_DIR
 
 ''' Shows a table of the evaluation results '''
 
-experiment, model_eval = evaluate()
+# The guard keeps the evaluation worker processes, which re-import this module, from running it again. Only the index
+# directories are needed: the systems open the indexes in their own processes, and the server indexes and the database
+# are not loaded.
+if __name__ == '__main__':
+    init_terrier()
+    restore_index_dir(CUSTOM_INDEX_DIR)
+    restore_index_dir(CONTROL_INDEX_DIR)
+    experiment, model_eval = evaluate()
 
-print(f'\nStopword list comparison:\n\n{experiment}')
-print(f'Retrieval model comparison:\n\n{model_eval}')
\ No newline at end of file
+    print(f'\nStopword list comparison:\n\n{experiment}')
+    print(f'Retrieval model comparison:\n\n{model_eval}')
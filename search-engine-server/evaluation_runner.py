@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import pathlib
+import re
+import pandas as pd
+import pyterrier as pt
+from retrievers import init_terrier, index_version, CUSTOM_INDEX_DIR, CONTROL_INDEX_DIR
+from trec_parsers import topics_parser
+from worker_pool import process_executor
+
+''' Runs the evaluated systems once each, in parallel processes, and caches their TREC run files '''
+
+SERVER_DIR = pathlib.Path(__file__).parent.resolve()
+TOPICS_FILE = os.path.join(SERVER_DIR, 'topics2021.xml')
+QRELS_FILE = os.path.join(SERVER_DIR, 'qrels2021.txt')
+
+# Directory of the cached run files, number of processes (each with its own JVM) running the systems, and number of
+# results retrieved per topic
+RUN_DIR = os.environ.get('EVAL_RUN_DIR', os.path.join(os.getcwd(), 'runs'))
+EVAL_PROCESSES = int(os.environ.get('EVAL_PROCESSES', os.cpu_count() or 1))
+EVAL_NUM_RESULTS = 1000
+
+
+def load_topics(path: str = TOPICS_FILE):
+    """
+    Reads the local TREC topics file into a (qid, query) dataframe. Queries are cleaned of non-word characters, which
+    Terrier's query parser would reject.
+
+    :param path: str
+    :return: DataFrame
+    """
+    topics = [(str(number), re.sub(r'\W+', ' ', content).strip()) for number, content in topics_parser(path)]
+    return pd.DataFrame(topics, columns=['qid', 'query'])
+
+
+def load_qrels(path: str = QRELS_FILE):
+    """
+    Reads the local TREC qrels file into a (qid, docno, label) dataframe.
+
+    :param path: str
+    :return: DataFrame
+    """
+    qrels = pd.read_csv(path, sep=r'\s+', header=None, names=['qid', 'iteration', 'docno', 'label'],
+                        dtype={'qid': str, 'iteration': str, 'docno': str, 'label': int})
+    return qrels[['qid', 'docno', 'label']]
+
+
+def run_path(system: dict, topics: pd.DataFrame):
+    """
+    Returns the path of the cached run file of a system. The file name is keyed by the index, its version, the model
+    config and the topics, so a rebuilt index or a changed config never reuses a stale run.
+
+    :param system: dict
+    :param topics: DataFrame
+    :return: str
+    """
+    key = json.dumps({
+        "index": os.path.abspath(system['index_dir']),
+        "version": index_version(system['index_dir']),
+        "wmodel": system['wmodel'],
+        "num_results": system['num_results'],
+        "topics": hashlib.sha1(topics.to_csv(index=False).encode('utf-8')).hexdigest(),
+    }, sort_keys=True)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(RUN_DIR, f"{system['name']}-{digest}.res")
+
+
+def run_system(system: dict, topics: pd.DataFrame, path: str):
+    """
+    Retrieves the results of a system for every topic and writes them to a TREC run file. Runs in a worker process,
+    which starts its own JVM and opens the index read-only.
+
+    :param system: dict
+    :param topics: DataFrame
+    :param path: str
+    :return: str
+    """
+    init_terrier()
+    index = pt.IndexFactory.of(os.path.join(os.path.abspath(system['index_dir']), "data.properties"))
+    retriever = pt.BatchRetrieve(index, wmodel=system['wmodel'], num_results=system['num_results'])
+    res = retriever.transform(topics)
+    tmp_path = f"{path}.tmp"
+    pt.io.write_results(res, tmp_path, format='trec', run_name=system['name'])
+    os.replace(tmp_path, path)  # an interrupted run never leaves a partial cached file
+    return path
+
+
+def get_runs(systems: list, topics: pd.DataFrame, processes: int = EVAL_PROCESSES):
+    """
+    Returns the results of every system as a dataframe keyed by system name. Systems without a cached run file are
+    run once, in parallel processes, and their run files are cached for the next evaluation.
+
+    :param systems: list(dict) - name, index_dir, wmodel and num_results of each system
+    :param topics: DataFrame
+    :param processes: int
+    :return: dict
+    """
+    os.makedirs(RUN_DIR, exist_ok=True)
+    paths = {system['name']: run_path(system, topics) for system in systems}
+    missing = [system for system in systems if not os.path.isfile(paths[system['name']])]
+    if missing:
+        print(f"Running {', '.join(system['name'] for system in missing)}")
+        with process_executor(min(processes, len(missing))) as pool:
+            futures = [pool.submit(run_system, system, topics, paths[system['name']]) for system in missing]
+            for future in futures:
+                future.result()
+    return {name: pt.io.read_results(path) for name, path in paths.items()}
+
+
+def evaluate():
+    """
+    Compare the results of using standard and custom stopword list
+
+    Topics and qrels are read from the files in the repository. Each system is run once (in parallel processes) and
+    its run file is cached, then all the measures are computed from the cached runs.
+
+    :return: a table of evaluation metric results. The first row(0) is the values for standard stopwords
+    """
+
+    topics = load_topics()  # we get the topics in a format easy to use with the pyterrier evaluator framework
+    qrels = load_qrels()  # we do the same with the relevancy files
+
+    systems = [
+        {"name": "bm25_custom", "index_dir": CUSTOM_INDEX_DIR, "wmodel": "BM25", "num_results": EVAL_NUM_RESULTS},  # bm-25 retrieval model that uses our custom list of stopwords
+        {"name": "bm25_control", "index_dir": CONTROL_INDEX_DIR, "wmodel": "BM25", "num_results": EVAL_NUM_RESULTS},  # now the model that we will use as control
+        {"name": "tf_idf_custom", "index_dir": CUSTOM_INDEX_DIR, "wmodel": "TF_IDF", "num_results": EVAL_NUM_RESULTS},
+    ]
+    runs = get_runs(systems, topics)
+
+    # Dataframe to show us the different evaluation metrics on the standard and custom stopword list
+
+    experiment = pt.Experiment([runs['bm25_custom'], runs['bm25_control']], topics, qrels,
+                               ['map', 'P_5', 'recall_5', 'num_rel', 'num_rel_ret'],
+                               names=['bm25_custom', 'bm25_control'])
+
+    sum_p_r = experiment['P_5'] + experiment['recall_5']
+    stopword_list = ['custom', 'standard']
+
+    experiment.insert(0, 'stopword_list', stopword_list)
+    experiment.insert(5, 'P+R', sum_p_r)
+
+    # Dataframe of the evaluation metrics of BM25 and TF-IDF
+
+    model_eval = pt.Experiment([runs['bm25_custom'], runs['tf_idf_custom']], topics, qrels,
+                               ['ndcg', 'Rprec', 'num_rel', 'num_rel_ret'],
+                               names=['bm25_custom', 'tf_idf_custom'])
+
+    pd.set_option('display.max_columns', None)
+
+    return experiment, model_eval
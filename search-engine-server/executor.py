@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import os
+import threading
+
+''' Bounded worker pools used to keep blocking work (Terrier scoring, pymongo calls) off the Quart event loop '''
+
+
+class ExecutorSaturated(Exception):
+    """ Raised when a pool already has as many pending jobs as its workers and queue allow """
+
+
+class BoundedExecutor:
+    """
+    A thread pool with a fixed number of workers and a bounded queue of waiting jobs. Jobs are awaited from the event
+    loop, so slow work in one request does not stall every other connection.
+
+    Attributes
+
+    name: str - name of the pool, used for the worker thread names and error messages
+
+    max_workers: int - number of jobs that run at the same time
+
+    max_queue: int - number of jobs allowed to wait for a free worker before new jobs are rejected
+
+    pending: int - number of jobs currently running or waiting, until their worker thread is done with them
+
+    Methods
+
+    run: Any - runs a blocking function on the pool and returns its result
+
+    release: None - counts a job out of pending once its worker thread is done with it
+
+    shutdown: None - waits for running jobs and stops the pool
+
+    """
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name: str = name
+        self.max_workers: int = max_workers
+        self.max_queue: int = max_queue
+        self.pending: int = 0
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) on the pool and returns its result. Raises ExecutorSaturated straight away when the
+        queue is full, so that the caller can shed load instead of piling up requests.
+
+        A job stays in pending until the pool is done with it, not until the caller stops waiting: a cancelled caller
+        (e.g. a client that disconnected) only frees its slot once its job has left the queue or finished running.
+
+        :param fn: callable
+        :return: Any
+        """
+        with self.lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                raise ExecutorSaturated(f'{self.name} pool is saturated ({self.pending} jobs pending)')
+            self.pending += 1
+        try:
+            future = self.pool.submit(functools.partial(fn, *args, **kwargs))
+        except Exception:
+            self.release()
+            raise
+        future.add_done_callback(self.release)  # also called when a queued job is cancelled
+        return await asyncio.wrap_future(future)
+
+    def release(self, future=None):
+        """
+        Counts a job out of pending. Called from the worker thread once the job is done, or from the thread that
+        cancelled it while it was still queued.
+
+        :param future: Future
+        :return: None
+        """
+        with self.lock:
+            self.pending -= 1
+
+    def shutdown(self):
+        """
+        Waits for running jobs and stops the pool.
+
+        :return: None
+        """
+        self.pool.shutdown(wait=True)
+
+
+# Terrier scoring is CPU bound inside the JVM, so the pool is sized to the cores by default.
+scoring_executor = BoundedExecutor('scoring',
+                                   max_workers=int(os.environ.get('SCORING_WORKERS', os.cpu_count() or 4)),
+                                   max_queue=int(os.environ.get('SCORING_QUEUE', 64)))
+
+# Document hydration waits on MongoDB, so more threads than cores are fine.
+hydration_executor = BoundedExecutor('hydration',
+                                     max_workers=int(os.environ.get('HYDRATION_WORKERS', 16)),
+                                     max_queue=int(os.environ.get('HYDRATION_QUEUE', 128)))
@@ -0,0 +1,87 @@
+import resource
+import time
+
+''' Throughput and memory reporting for index builds '''
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process and of its finished child processes (e.g. preprocessing
+    workers), in megabytes.
+
+    :return: float
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024  # ru_maxrss is in kilobytes on Linux
+
+
+class IndexingProgress:
+    """
+    Wraps the iterable of documents passed to an indexer, counting the documents as the indexer consumes them and
+    printing the throughput and peak memory every `every` documents and at the end.
+
+    Attributes
+
+    docs: iterable - the documents fed to the indexer
+
+    label: str - name of the index, used in the printed reports
+
+    every: int - number of documents between two reports
+
+    count: int - number of documents consumed so far
+
+    start: float | None - time the indexer started consuming documents
+
+    end: float | None - time the last document was consumed
+
+    Methods
+
+    report: dict - returns the number of documents, elapsed seconds, docs/sec and peak RSS
+
+    """
+    def __init__(self, docs, label: str, every: int = 10000):
+        self.docs = docs
+        self.label: str = label
+        self.every: int = every
+        self.count: int = 0
+        self.start: float | None = None
+        self.end: float | None = None
+
+    def __iter__(self):
+        self.start = time.perf_counter()
+        for doc in self.docs:
+            yield doc
+            self.count += 1
+            if self.count % self.every == 0:
+                self.print_report()
+        self.end = time.perf_counter()
+        self.print_report()
+
+    def report(self):
+        """
+        Returns the number of documents consumed, the elapsed seconds, the documents per second and the peak RSS in
+        megabytes.
+
+        :return: dict
+        """
+        if self.start is None:
+            seconds = 0.0
+        else:
+            seconds = (self.end or time.perf_counter()) - self.start
+        return {
+            "docs": self.count,
+            "seconds": round(seconds, 2),
+            "docs_per_sec": round(self.count / seconds, 1) if seconds > 0 else 0.0,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+
+    def print_report(self):
+        """
+        Prints the current report.
+
+        :return: None
+        """
+        report = self.report()
+        print(f"{self.label}: {report['docs']} docs in {report['seconds']}s || {report['docs_per_sec']} docs/sec || "
+              f"peak RSS {report['peak_rss_mb']} MB")
@@ -0,0 +1,158 @@
+from functools import lru_cache
+import json
+import math
+import os
+import re
+import numpy as np
+from nltk.stem.porter import PorterStemmer
+
+''' Query term statistics (df, cf, idf) served from a memory-mapped copy of the lexicon of a Terrier index '''
+
+LEXICON_STATS = 'stats.json'
+LEXICON_ARRAYS = ('terms', 'df', 'cf')
+
+# Terrier's EnglishTokeniser: lower-cased runs of letters and digits, at most 20 characters, at most 4 digits and no
+# character repeated more than 3 times in a row
+MAX_TERM_LENGTH = 20
+MAX_TERM_DIGITS = 4
+MAX_TERM_REPEATS = 3
+
+# Porter's own reference implementation, which Terrier's PorterStemmer is a port of
+porter_stemmer = PorterStemmer(mode=PorterStemmer.MARTIN_EXTENSIONS)
+
+
+@lru_cache(maxsize=65536)
+def stem(token: str):
+    """
+    Returns the Porter stem of a lower-cased token, as Terrier's PorterStemmer stems it.
+
+    :param token: str
+    :return: str
+    """
+    return porter_stemmer.stem(token, to_lowercase=False)
+
+
+def tokenize(query: str):
+    """
+    Splits a query into tokens the way Terrier's EnglishTokeniser splits documents and queries.
+
+    :param query: str
+    :return: list(str)
+    """
+    tokens = list()
+    for token in re.findall(r'[a-z0-9]+', query.lower()):
+        if len(token) > MAX_TERM_LENGTH or sum(c.isdigit() for c in token) > MAX_TERM_DIGITS:
+            continue
+        if re.search(r'(.)\1{%d}' % MAX_TERM_REPEATS, token):
+            continue
+        tokens.append(token)
+    return tokens
+
+
+class LexiconTable:
+    """
+    The lexicon of a Terrier index held in numpy arrays: the index terms sorted so that they are found with a binary
+    search, and the document frequency and collection frequency of each term. The arrays are saved as .npy files and
+    memory-mapped, so a lookup never goes through the JVM. The table is copied from the Terrier lexicon once per version
+    of the index, into a new directory, so that a table in use is never overwritten.
+
+    Attributes
+
+    directory: str - the directory the table is saved in
+
+    arrays: dict - the memory-mapped arrays of the table
+
+    stats: dict - number of documents and of terms, and version of the index the table was copied from
+
+    Methods
+
+    exists: bool - whether a complete table is saved in the directory
+
+    build: int - copies the lexicon of a Terrier index, returns the number of terms
+
+    load: None - memory-maps the table
+
+    lookup: list - df, cf and idf of every term of a query
+
+    """
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        self.arrays: dict = dict()
+        self.stats: dict = dict()
+
+    def exists(self):
+        """
+        Returns True if a complete table is saved in the directory.
+
+        :return: bool
+        """
+        return os.path.isfile(os.path.join(self.directory, LEXICON_STATS))
+
+    def build(self, index, version: str = ''):
+        """
+        Copies the lexicon of a Terrier index into the table.
+
+        :param index: Index
+        :param version: str - version of the index, see retrievers.index_version
+        :return: int
+        """
+        terms, df, cf = list(), list(), list()
+        for entry in index.getLexicon():
+            terms.append(entry.getKey())
+            df.append(entry.getValue().getDocumentFrequency())
+            cf.append(entry.getValue().getFrequency())
+        terms = np.array(terms, dtype=str)
+        order = np.argsort(terms, kind='stable')  # Java orders strings by UTF-16 code unit, numpy by code point
+
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {
+            'terms': terms[order],
+            'df': np.array(df, dtype=np.int64)[order],
+            'cf': np.array(cf, dtype=np.int64)[order],
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(self.directory, f'{name}.npy'), array)
+        n_docs = index.getCollectionStatistics().getNumberOfDocuments()
+        with open(os.path.join(self.directory, LEXICON_STATS), 'w') as f:  # written last: the table is complete
+            json.dump({'n_docs': n_docs, 'n_terms': len(terms), 'version': version}, f)
+        return len(terms)
+
+    def load(self):
+        """
+        Memory-maps the table.
+
+        :return: None
+        """
+        with open(os.path.join(self.directory, LEXICON_STATS), 'r') as f:
+            self.stats = json.load(f)
+        self.arrays = {name: np.load(os.path.join(self.directory, f'{name}.npy'), mmap_mode='r')
+                       for name in LEXICON_ARRAYS}
+
+    def lookup(self, query: str):
+        """
+        Tokenizes and stems the query like the index and returns, for every token in query order, its index term,
+        document frequency, collection frequency and IDF (log2(N / df), 0 for terms not in the index).
+
+        :param query: str
+        :return: list(dict)
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return list()
+        terms = self.arrays['terms']
+        stems = [stem(token) for token in tokens]
+        positions = np.searchsorted(terms, stems)
+        n_docs = self.stats['n_docs']
+        results = list()
+        for token, term, position in zip(tokens, stems, positions.tolist()):
+            df = cf = 0
+            if position < len(terms) and terms[position] == term:
+                df, cf = int(self.arrays['df'][position]), int(self.arrays['cf'][position])
+            results.append({
+                "name": token,
+                "term": term,
+                "df": df,
+                "cf": cf,
+                "idf": math.log2(n_docs / df) if df else 0.0,
+            })
+        return results
@@ -0,0 +1,424 @@
+import json
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+from textanalyser import list_words
+
+''' In-process BM25 / TF-IDF scoring over the term-document matrix, as an alternative to the Terrier retrievers '''
+
+NATIVE_STATS = 'stats.json'
+NATIVE_ARRAYS = ('indptr', 'indices', 'tf', 'norm', 'terms', 'docnos', 'idf_bm25', 'idf_tf_idf')
+NATIVE_WMODELS = ("BM25", "TF_IDF")
+# Largest and smallest weight of a posting of each term, per weighting model, for dynamic pruning
+NATIVE_BOUNDS = ('max_bm25', 'min_bm25', 'max_tf_idf', 'min_tf_idf')
+
+# Relative slack on the pruning threshold, so that a document is never pruned because its partial score was summed in
+# a different order (and rounded differently) from its final score
+PRUNING_SLACK = 1e-5
+
+# Terrier's default parameters, so that both engines score with the same formulas. BM25_K3 saturates the frequency of a
+# term repeated in the query, as Terrier's BM25 does (its TF_IDF uses the raw query frequency).
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_K3 = 8.0
+
+
+def collection_statistics(matrix: csr_matrix, terms: list, exclude: frozenset = frozenset()):
+    """
+    Returns the number of documents, the average document length (leaving out the terms in exclude) and the document
+    frequency of every column of a documents x terms frequency matrix.
+
+    :param matrix: csr_matrix
+    :param terms: list
+    :param exclude: frozenset
+    :return: dict
+    """
+    keep = np.flatnonzero([term not in exclude for term in terms])
+    doc_len = np.asarray(matrix[:, keep].sum(axis=1), dtype=np.float64).ravel()
+    return {
+        'n_docs': matrix.shape[0],
+        'avg_doc_len': float(doc_len.mean()) if matrix.shape[0] else 0.0,
+        'df': np.diff(matrix.tocsc().indptr).astype(np.float64),
+    }
+
+
+class NativeIndex:
+    """
+    An inverted index held in numpy arrays: the term-document matrix in CSC layout (one column of postings per term,
+    terms sorted so that they are found with a binary search), the term frequency of each posting, the document length
+    norm of each document and the IDF of each term for every weighting model. The arrays are saved as .npy files and
+    memory-mapped, so loading is almost instant and the index is not copied into the JVM.
+
+    A query is scored by gathering the posting columns of its terms, weighting every posting in one vectorised
+    expression, summing the weights per document with np.bincount and selecting the top k with np.argpartition.
+
+    The weights follow Terrier's BM25 and TF_IDF formulas, but documents and queries are tokenized by
+    textanalyser.list_words, like the term-document matrix, without Terrier's stemming. Scores and rankings are
+    therefore close to, not equal to, those of the Terrier retrievers.
+
+    search_maxscore returns the same top k with MaxScore dynamic pruning: the largest weight of each term is saved at
+    build time, and once the k-th best partial score beats the sum of the bounds of the terms left to score, the rest
+    of the postings are only looked up for the documents that can still reach the top k.
+
+    Attributes
+
+    directory: str - the directory the index is saved in
+
+    arrays: dict - the memory-mapped arrays of the index
+
+    stats: dict - number of documents, number of terms, average document length, number of documents of the collection
+    the IDFs were computed on and version of the saved index
+
+    Methods
+
+    exists: bool - whether the index files are present in the directory
+
+    build: int - writes the index from a documents x terms frequency matrix, returns the number of documents
+
+    load: None - memory-maps the index
+
+    write_bounds: None - saves the largest and smallest posting weight of every term
+
+    term_ids: tuple - column and query frequency of the query terms found in the index
+
+    lookup: list - IDF of every distinct query term
+
+    postings: tuple - rows, term frequencies and column number of the postings of some columns
+
+    query_weight: ndarray - weight of the query frequency of terms under a weighting model
+
+    weights: ndarray - weights of postings under a weighting model
+
+    score: tuple - rows and scores of every document matching at least one query term
+
+    search: tuple - docnos and scores of the top k documents for a query
+
+    search_maxscore: tuple - docnos and scores of the same top k documents, with MaxScore pruning, and the number of
+    postings evaluated
+
+    """
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        self.arrays: dict = dict()
+        self.stats: dict = dict()
+
+    def exists(self):
+        """
+        Returns True if the index files are present in the directory.
+
+        :return: bool
+        """
+        return os.path.isfile(os.path.join(self.directory, NATIVE_STATS))
+
+    def build(self, matrix: csr_matrix, terms: list, docnos: list, exclude: frozenset = frozenset(),
+              collection: dict = None):
+        """
+        Writes the index from a documents x terms frequency matrix (e.g. TermDocumentMatrix.matrix), the term of each
+        column and the docno of each row. Terms in exclude (e.g. the inferred stopwords) are left out of the postings
+        and of the document lengths, as they are left out of the custom Terrier index.
+
+        The IDFs and the document length norms use the statistics of collection (see collection_statistics), by default
+        those of the matrix itself. A shard built with the statistics of the whole collection scores its documents
+        exactly as the index of the whole collection does.
+
+        :param matrix: csr_matrix
+        :param terms: list
+        :param docnos: list
+        :param exclude: frozenset
+        :param collection: dict
+        :return: int
+        """
+        if collection is None:
+            collection = collection_statistics(matrix, terms, exclude)
+        terms = np.array(terms, dtype=str)
+        keep = np.array([term not in exclude for term in terms.tolist()], dtype=bool)
+        order = np.flatnonzero(keep)[np.argsort(terms[keep], kind='stable')]
+        csc = matrix.tocsc()[:, order]
+        csc.sort_indices()
+
+        doc_len = np.asarray(csc.sum(axis=1), dtype=np.float64).ravel()
+        n_docs = len(docnos)
+        n_collection, avg_doc_len = collection['n_docs'], collection['avg_doc_len']
+        df = collection['df'][order]
+
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {
+            'indptr': csc.indptr.astype(np.int64),
+            'indices': csc.indices.astype(np.int32),
+            'tf': csc.data.astype(np.float32),
+            'norm': (BM25_K1 * (1 - BM25_B + BM25_B * doc_len / max(avg_doc_len, 1e-9))).astype(np.float32),
+            'terms': terms[order],
+            'docnos': np.array(docnos, dtype=str),
+            'idf_bm25': np.log2((n_collection - df + 0.5) / (df + 0.5)).astype(np.float32),
+            'idf_tf_idf': np.log2(n_collection / np.maximum(df, 1) + 1).astype(np.float32),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(self.directory, f'{name}.npy'), array)
+        self.arrays = arrays
+        self.write_bounds()
+        with open(os.path.join(self.directory, NATIVE_STATS), 'w') as f:
+            json.dump({'n_docs': n_docs, 'n_terms': len(order), 'avg_doc_len': avg_doc_len,
+                       'collection_docs': n_collection}, f)
+        return n_docs
+
+    def write_bounds(self):
+        """
+        Saves the largest and smallest weight of the postings of every term (query frequency 1), for each weighting
+        model. Terms without postings get 0.
+
+        :return: None
+        """
+        indptr = self.arrays['indptr']
+        df = np.diff(indptr)
+        nonempty = np.flatnonzero(df > 0)
+        term = np.repeat(np.arange(len(df)), df)
+        rows = self.arrays['indices']
+        for wmodel in NATIVE_WMODELS:
+            key = wmodel.lower()
+            weights = self.weights(wmodel, self.arrays[f'idf_{key}'][term], self.arrays['tf'], self.arrays['norm'][rows],
+                                   np.float32(1))
+            for name, reduce in ((f'max_{key}', np.maximum), (f'min_{key}', np.minimum)):
+                bounds = np.zeros(len(df), dtype=np.float32)
+                if len(nonempty):
+                    # segments between consecutive non-empty columns hold exactly the postings of the first one
+                    bounds[nonempty] = reduce.reduceat(weights, indptr[nonempty])
+                np.save(os.path.join(self.directory, f'{name}.npy'), bounds)
+                self.arrays[name] = bounds
+
+    def load(self):
+        """
+        Memory-maps the index arrays.
+
+        :return: None
+        """
+        with open(os.path.join(self.directory, NATIVE_STATS), 'r') as f:
+            self.stats = json.load(f)
+        self.stats['version'] = str(os.stat(os.path.join(self.directory, NATIVE_STATS)).st_mtime_ns)  # changes on rebuild
+        self.arrays = {name: np.load(os.path.join(self.directory, f'{name}.npy'), mmap_mode='r')
+                       for name in NATIVE_ARRAYS}
+        if not all(os.path.isfile(os.path.join(self.directory, f'{name}.npy')) for name in NATIVE_BOUNDS):
+            self.write_bounds()  # index saved before the bounds were added
+        for name in NATIVE_BOUNDS:
+            self.arrays[name] = np.load(os.path.join(self.directory, f'{name}.npy'), mmap_mode='r')
+
+    def term_ids(self, query: str):
+        """
+        Tokenizes the query like the term-document matrix (textanalyser.list_words) and returns the columns of the
+        query terms found in the index with their frequency in the query.
+
+        :param query: str
+        :return: tuple(ndarray, ndarray)
+        """
+        query_terms = list_words(query)['all']
+        if not query_terms:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        terms = self.arrays['terms']
+        words = np.array(list(query_terms), dtype=str)
+        positions = np.searchsorted(terms, words)
+        found = positions < len(terms)
+        found[found] = terms[positions[found]] == words[found]
+        qtf = np.fromiter(query_terms.values(), dtype=np.float32, count=len(query_terms))
+        return positions[found].astype(np.int64), qtf[found]
+
+    def lookup(self, query: str, wmodel: str = "BM25"):
+        """
+        Tokenizes the query like term_ids and returns every distinct query term in query order with its IDF under the
+        weighting model, None for terms not in the index.
+
+        :param query: str
+        :param wmodel: str: BM25 or TF_IDF
+        :return: list(tuple(str, float | None))
+        """
+        if wmodel not in NATIVE_WMODELS:
+            raise ValueError(f'unknown weighting model {wmodel}, expected one of {NATIVE_WMODELS}')
+        words = list(list_words(query)['all'])
+        if not words:
+            return list()
+        terms, idf = self.arrays['terms'], self.arrays[f'idf_{wmodel.lower()}']
+        positions = np.searchsorted(terms, np.array(words, dtype=str)).tolist()
+        return [(word, float(idf[position]) if position < len(terms) and terms[position] == word else None)
+                for word, position in zip(words, positions)]
+
+    def postings(self, columns: np.ndarray):
+        """
+        Returns the document rows, term frequencies and column number (position in columns) of every posting of the
+        given columns, concatenated.
+
+        :param columns: ndarray
+        :return: tuple(ndarray, ndarray, ndarray)
+        """
+        indptr = self.arrays['indptr']
+        starts, ends = indptr[columns], indptr[columns + 1]
+        lengths = ends - starts
+        total = int(lengths.sum())
+        # positions of all the postings in the index arrays, without a Python loop over the postings
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        positions = np.arange(total, dtype=np.int64) + offsets
+        term_of_posting = np.repeat(np.arange(len(columns)), lengths)
+        return self.arrays['indices'][positions], self.arrays['tf'][positions], term_of_posting
+
+    @staticmethod
+    def query_weight(wmodel: str, qtf):
+        """
+        Returns the factor a posting weight is multiplied by for a term appearing qtf times in the query: BM25
+        saturates it with k3, TF_IDF uses it as is. A term appearing once gets exactly 1.
+
+        :param wmodel: str: BM25 or TF_IDF
+        :param qtf: ndarray
+        :return: ndarray
+        """
+        if wmodel == "BM25":
+            return (BM25_K3 + 1) * qtf / (BM25_K3 + qtf)
+        if wmodel == "TF_IDF":
+            return qtf
+        raise ValueError(f'unknown weighting model {wmodel}, expected one of {NATIVE_WMODELS}')
+
+    @staticmethod
+    def weights(wmodel: str, idf, tf: np.ndarray, norm: np.ndarray, qtf):
+        """
+        Returns the weight of postings given their IDF, term frequency, document length norm and query frequency
+        (arrays of the same length, or arrays of length 1 broadcast over the postings of one term). Every scoring path
+        goes through this expression, so they all compute bit for bit the same weights.
+
+        :param wmodel: str: BM25 or TF_IDF
+        :param idf: ndarray
+        :param tf: ndarray
+        :param norm: ndarray
+        :param qtf: ndarray
+        :return: ndarray
+        """
+        if wmodel == "BM25":
+            return idf * (BM25_K1 + 1) * tf / (norm + tf) * NativeIndex.query_weight(wmodel, qtf)
+        if wmodel == "TF_IDF":
+            return idf * BM25_K1 * tf / (tf + norm) * NativeIndex.query_weight(wmodel, qtf)
+        raise ValueError(f'unknown weighting model {wmodel}, expected one of {NATIVE_WMODELS}')
+
+    def score(self, query: str, wmodel: str = "BM25"):
+        """
+        Scores every document matching at least one query term and returns their rows and scores.
+
+        :param query: str
+        :param wmodel: str: BM25 or TF_IDF
+        :return: tuple(ndarray, ndarray)
+        """
+        columns, qtf = self.term_ids(query)
+        if len(columns) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        rows, tf, term = self.postings(columns)
+        if wmodel not in NATIVE_WMODELS:
+            raise ValueError(f'unknown weighting model {wmodel}, expected one of {NATIVE_WMODELS}')
+        idf = self.arrays[f'idf_{wmodel.lower()}'][columns]
+        weights = self.weights(wmodel, idf[term], tf, self.arrays['norm'][rows], qtf[term])
+        n_docs = self.stats['n_docs']
+        totals = np.bincount(rows, weights=weights, minlength=n_docs)
+        seen = np.zeros(n_docs, dtype=bool)
+        seen[rows] = True
+        matched = np.flatnonzero(seen)
+        return matched, totals[matched]
+
+    def top_k(self, rows: np.ndarray, scores: np.ndarray, k: int):
+        """
+        Returns the positions of the k best scores, best first. Ties are broken by the lowest docno, including at the
+        k-th place, so the same scores always give the same ranking, whichever index or shard the documents are in.
+
+        :param rows: ndarray
+        :param scores: ndarray
+        :param k: int
+        :return: ndarray
+        """
+        if len(rows) > k:
+            kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+            selected = np.flatnonzero(scores >= kth)
+        else:
+            selected = np.arange(len(rows))
+        docnos = self.arrays['docnos'][rows[selected]]
+        return selected[np.lexsort((docnos, -scores[selected]))[:k]]
+
+    def search(self, query: str, wmodel: str = "BM25", k: int = 1000):
+        """
+        Returns the docnos and scores of the k best documents for the query, best first.
+
+        :param query: str
+        :param wmodel: str
+        :param k: int
+        :return: tuple(list, ndarray)
+        """
+        rows, scores = self.score(query, wmodel)
+        top = self.top_k(rows, scores, k)
+        return self.arrays['docnos'][rows[top]].tolist(), scores[top]
+
+    def search_maxscore(self, query: str, wmodel: str = "BM25", k: int = 1000):
+        """
+        Returns the same docnos and scores as search, best first, with MaxScore dynamic pruning, and the number of
+        postings evaluated.
+
+        Terms are scored from the largest to the smallest upper bound. While the k-th best partial score (a lower bound
+        of its final score) does not beat the sum of the upper bounds of the terms left, every posting is scored. Once
+        it does, a document not seen yet cannot reach the top k, so the remaining terms are only looked up (by binary
+        search in their posting columns) for the candidates, and candidates whose partial score plus the bounds left
+        falls below the threshold are dropped after every term. The final scores of the candidates are summed in the
+        query term order of score, so they equal the exhaustive scores exactly.
+
+        :param query: str
+        :param wmodel: str
+        :param k: int
+        :return: tuple(list, ndarray, int)
+        """
+        if wmodel not in NATIVE_WMODELS:
+            raise ValueError(f'unknown weighting model {wmodel}, expected one of {NATIVE_WMODELS}')
+        columns, qtf = self.term_ids(query)
+        if len(columns) == 0:
+            return list(), np.zeros(0, dtype=np.float64), 0
+        key = wmodel.lower()
+        idf = self.arrays[f'idf_{key}'][columns]
+        # the bounds are saved for a query frequency of 1, whose query weight is exactly 1
+        query_weight = self.query_weight(wmodel, qtf)
+        upper = np.maximum(self.arrays[f'max_{key}'][columns] * query_weight, 0).astype(np.float64)
+        lower = np.minimum(self.arrays[f'min_{key}'][columns] * query_weight, 0).astype(np.float64)
+        order = np.argsort(-upper, kind='stable')
+        # bounds of the contribution of the terms after each step (negative weights, e.g. BM25 IDF of very frequent
+        # terms, make the lower bound of a partial score smaller than the partial score)
+        upper_left = np.concatenate((np.cumsum(upper[order][::-1])[::-1][1:], [0.0]))
+        lower_left = np.concatenate((np.cumsum(lower[order][::-1])[::-1][1:], [0.0]))
+
+        indptr, indices, tf, norm = self.arrays['indptr'], self.arrays['indices'], self.arrays['tf'], self.arrays['norm']
+        n_docs = self.stats['n_docs']
+        partial = np.zeros(n_docs, dtype=np.float64)
+        seen = np.zeros(n_docs, dtype=bool)
+        scored = [None] * len(columns)
+        candidates = None
+        evaluated = 0
+        for step, term in enumerate(order):
+            start, end = int(indptr[columns[term]]), int(indptr[columns[term] + 1])
+            if candidates is None:
+                rows, positions = indices[start:end], np.arange(start, end)
+                seen[rows] = True
+                evaluated += end - start
+            else:
+                # posting rows are sorted within a column, so each candidate is a binary search away
+                found = np.searchsorted(indices[start:end], candidates)
+                hit = found < end - start
+                hit[hit] = indices[start:end][found[hit]] == candidates[hit]
+                rows, positions = candidates[hit], start + found[hit]
+                evaluated += len(candidates)
+            weights = self.weights(wmodel, idf[term:term + 1], tf[positions], norm[rows], qtf[term:term + 1])
+            partial[rows] += weights
+            scored[term] = (rows, weights)
+
+            pool = np.flatnonzero(seen) if candidates is None else candidates
+            if len(pool) < k:
+                continue
+            threshold = np.partition(partial[pool] + lower_left[step], len(pool) - k)[len(pool) - k]
+            threshold -= PRUNING_SLACK * (abs(threshold) + 1)
+            if candidates is None and upper_left[step] >= threshold:
+                continue
+            candidates = pool[partial[pool] + upper_left[step] >= threshold]
+
+        if candidates is None:
+            candidates = np.flatnonzero(seen)
+        totals = np.zeros(n_docs, dtype=np.float64)
+        for rows, weights in scored:
+            totals[rows] += weights
+        scores = totals[candidates]
+        top = self.top_k(candidates, scores, k)
+        return self.arrays['docnos'][candidates[top]].tolist(), scores[top], evaluated
@@ -0,0 +1,101 @@
+from collections import deque
+import os
+import nltk
+from nltk import word_tokenize
+from stopwords import custom_stopword_list
+from worker_pool import process_pool
+
+''' Streaming preprocessing of the corpus for the custom index: tokenize and remove the inferred stopwords '''
+
+# Documents sent to a worker at a time, and number of worker processes (defaults to the number of cores)
+PREPROCESS_BATCH_SIZE = int(os.environ.get('PREPROCESS_BATCH_SIZE', 200))
+PREPROCESS_PROCESSES = int(os.environ.get('PREPROCESS_PROCESSES', os.cpu_count() or 1))
+
+
+def ensure_nltk_data():
+    """
+    Downloads the punkt tokenizer models used by word_tokenize, only if they are not installed already.
+
+    :return: None
+    """
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        nltk.download('punkt')
+
+
+def custom_preprocess(text):
+    custom_stopword = custom_stopword_list()  # frozenset, only re-read when the csv file changes
+    toks = word_tokenize(text)  # tokenize
+    toks = [t for t in toks if t.lower() not in custom_stopword]  # remove stop words
+    return ' '.join(toks)  # combine toks back into a string
+
+
+def remove_custom_stopwords(query: str):
+    """
+    Removes the inferred stopwords from a query cleaned of non-word characters, as custom_preprocess does for the
+    documents of the custom index.
+
+    :param query: str
+    :return: str
+    """
+    custom_stopword = custom_stopword_list()
+    return ' '.join(t for t in query.split() if t.lower() not in custom_stopword)
+
+
+def preprocess_batch(batch: list):
+    """
+    Preprocesses a batch of database documents (clinical_id, raw_text) into the dicts expected by the Terrier
+    indexers.
+
+    :param batch: list
+    :return: list(dict)
+    """
+    return [{'docno': doc['clinical_id'], 'text': custom_preprocess(doc.get('raw_text') or '')} for doc in batch]
+
+
+def batched(docs, batch_size: int):
+    """
+    Groups an iterable of documents into lists of batch_size documents.
+
+    :param docs: iterable
+    :param batch_size: int
+    :return: generator(list)
+    """
+    batch = list()
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def preprocess_documents(docs, batch_size: int = PREPROCESS_BATCH_SIZE, processes: int = PREPROCESS_PROCESSES):
+    """
+    Preprocesses an iterable of database documents across a pool of processes and yields {'docno', 'text'} dicts in
+    the original order, ready to be passed to pt.IterDictIndexer. Documents are read lazily, so only a few batches per
+    worker are in memory at any time.
+
+    :param docs: iterable - e.g. a database cursor over clinical_id and raw_text
+    :param batch_size: int
+    :param processes: int
+    :return: generator(dict)
+    """
+    ensure_nltk_data()
+    if processes <= 1:
+        for batch in batched(docs, batch_size):
+            yield from preprocess_batch(batch)
+        return
+
+    # Spawned workers do not inherit the JVM threads of the parent process. Pool.imap would read the whole cursor
+    # ahead of the workers, so at most two batches per worker are submitted at a time.
+    with process_pool(processes, initializer=ensure_nltk_data) as pool:
+        pending = deque()
+        for batch in batched(docs, batch_size):
+            pending.append(pool.apply_async(preprocess_batch, (batch,)))
+            if len(pending) >= 2 * processes:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
@@ -0,0 +1,89 @@
+import os
+from stopwords import custom_stopword_list
+
+''' Query reduction: shortens verbose queries (e.g. patient descriptions) to their most discriminative terms '''
+
+# Number of terms kept per query, by IDF in the index lexicon, after the inferred stopwords and repeated terms are
+# removed. 0 turns the reduction off: only the inferred stopwords are removed.
+QUERY_MAX_TERMS = int(os.environ.get('QUERY_MAX_TERMS', 0))
+
+
+class QueryReducer:
+    """
+    Reduces a query cleaned of non-word characters to at most max_terms terms: the inferred stopwords are dropped,
+    terms that match the same index term are collapsed into their first occurrence, terms missing from the index are
+    dropped and only the max_terms terms with the highest IDF are kept, in their original order.
+
+    Terms are looked up in the index the engine searches, without calling the JVM. For the terrier engine they are
+    tokenized and stemmed like Terrier and looked up in the lexicon table of the Terrier index (see lexicon_table.py).
+    The native and sharded engines do not stem, so for them terms are tokenized like the term-document matrix and
+    looked up in the native index itself.
+
+    Attributes
+
+    lexicon_tables: dict - the lexicon table of each Terrier index, keyed by name
+
+    native_indexes: dict - the native index of each name
+
+    sharded_indexes: dict - the sharded native index of each name
+
+    max_terms: int - number of terms kept per query, 0 for no reduction
+
+    Methods
+
+    term_idfs: list - query term, index term and IDF of every term of a query in the index an engine searches
+
+    reduce: str - the reduced query
+
+    """
+    def __init__(self, lexicon_tables: dict, native_indexes: dict, sharded_indexes: dict,
+                 max_terms: int = QUERY_MAX_TERMS):
+        self.lexicon_tables: dict = lexicon_tables
+        self.native_indexes: dict = native_indexes
+        self.sharded_indexes: dict = sharded_indexes
+        self.max_terms: int = max_terms
+
+    def term_idfs(self, name: str, query: str, engine: str = "terrier"):
+        """
+        Returns the query term, index term and IDF of every term of the query, in query order, in the named index of
+        the engine. The IDF is None for terms not in the index.
+
+        :param name: str
+        :param query: str
+        :param engine: str: "terrier", "native" or "sharded"
+        :return: list(tuple(str, str, float | None))
+        """
+        if engine == "native":
+            return [(term, term, idf) for term, idf in self.native_indexes[name].lookup(query)]
+        if engine == "sharded":
+            return [(term, term, idf) for term, idf in self.sharded_indexes[name].lookup(query)]
+        return [(entry["name"], entry["term"], entry["idf"] if entry["df"] else None)
+                for entry in self.lexicon_tables[name].lookup(query)]
+
+    def reduce(self, name: str, query: str, max_terms: int = None, engine: str = "terrier"):
+        """
+        Returns the query reduced to its max_terms terms of highest IDF in the named index of the engine
+        (QueryReducer.max_terms by default). With max_terms 0 only the inferred stopwords are removed.
+
+        :param name: str
+        :param query: str
+        :param max_terms: int
+        :param engine: str: "terrier", "native" or "sharded"
+        :return: str
+        """
+        max_terms = self.max_terms if max_terms is None else max_terms
+        custom_stopword = custom_stopword_list()
+        terms = [t for t in query.split() if t.lower() not in custom_stopword]
+        if max_terms <= 0:
+            return ' '.join(terms)
+
+        seen = set()
+        candidates = list()  # (idf, position, term) of the first occurrence of every index term
+        for position, (term, index_term, idf) in enumerate(self.term_idfs(name, ' '.join(terms), engine)):
+            if index_term in seen:
+                continue
+            seen.add(index_term)
+            if idf is not None:
+                candidates.append((idf, position, term))
+        best = sorted(candidates, key=lambda item: (-item[0], item[1]))[:max_terms]
+        return ' '.join(term for idf, position, term in sorted(best, key=lambda item: item[1]))
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+import os
+import re
+import sys
+import threading
+import time
+
+''' In-process cache of ranked results for repeated queries '''
+
+
+def normalise_query(query: str):
+    """
+    Returns the form of the query used in cache keys: lowercase with single spaces between words.
+
+    :param query: str
+    :return: str
+    """
+    return re.sub(r'\s+', ' ', query).strip().lower()
+
+
+class ResultCache:
+    """
+    An LRU cache with a time to live for ranked lists of docnos. Entries are keyed on the normalised query, the index
+    name and version and the weighting model, and remember the depth they were retrieved at so that any page within
+    that depth is served from the cache.
+
+    Attributes
+
+    max_entries: int - maximum number of cached queries
+
+    max_bytes: int - approximate upper bound for the memory used by cached entries
+
+    ttl: float - number of seconds an entry stays valid
+
+    entries: OrderedDict - cached entries, least recently used first
+
+    size: int - approximate memory used by cached entries
+
+    hits: int - number of lookups answered by the cache
+
+    misses: int - number of lookups that had to go to the retriever
+
+    evictions: int - number of entries dropped to respect max_entries / max_bytes
+
+    expirations: int - number of entries dropped because they outlived the ttl
+
+    Methods
+
+    get: list | None - returns the cached docnos for a query if they cover the requested depth
+
+    put: None - stores the docnos retrieved for a query
+
+    invalidate_index: int - drops every entry for an index, returns the number of entries dropped
+
+    stats: dict - returns the hit / miss counters and the current size of the cache
+
+    """
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024, ttl: float = 3600):
+        self.max_entries: int = max_entries
+        self.max_bytes: int = max_bytes
+        self.ttl: float = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(key: tuple, docnos: list):
+        """
+        Returns the approximate number of bytes held by an entry.
+
+        :param key: tuple
+        :param docnos: list
+        :return: int
+        """
+        return sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key) + sys.getsizeof(docnos) + \
+            sum(sys.getsizeof(docno) for docno in docnos)
+
+    def drop(self, key: tuple):
+        """
+        Removes an entry, the lock must be held by the caller.
+
+        :param key: tuple
+        :return: None
+        """
+        expires, depth, docnos, size = self.entries.pop(key)
+        self.size -= size
+
+    def get(self, query: str, index_name: str, index_version: str, wmodel: str, depth: int):
+        """
+        Returns the cached docnos for the query if an entry exists, has not expired and was retrieved at least as deep as
+        depth. Returns None otherwise.
+
+        :param query: str
+        :param index_name: str
+        :param index_version: str
+        :param wmodel: str
+        :param depth: int
+        :return: list | None
+        """
+        key = (normalise_query(query), index_name, index_version, wmodel)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, cached_depth, docnos, size = entry
+                if expires < time.monotonic():
+                    self.drop(key)
+                    self.expirations += 1
+                # A list shorter than its depth holds every match for the query, so it covers any depth
+                elif cached_depth >= depth or len(docnos) < cached_depth:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return docnos
+            self.misses += 1
+            return None
+
+    def put(self, query: str, index_name: str, index_version: str, wmodel: str, depth: int, docnos: list):
+        """
+        Stores the docnos retrieved for the query at the given depth and evicts the least recently used entries until
+        the cache is within its limits.
+
+        :param query: str
+        :param index_name: str
+        :param index_version: str
+        :param wmodel: str
+        :param depth: int
+        :param docnos: list
+        :return: None
+        """
+        key = (normalise_query(query), index_name, index_version, wmodel)
+        size = self.entry_size(key, docnos)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (time.monotonic() + self.ttl, depth, docnos, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate_index(self, index_name: str):
+        """
+        Drops every entry retrieved from the named index, whatever its version.
+
+        :param index_name: str
+        :return: int
+        """
+        with self.lock:
+            stale = [key for key in self.entries if key[1] == index_name]
+            for key in stale:
+                self.drop(key)
+        return len(stale)
+
+    def stats(self):
+        """
+        Returns the hit / miss counters and the current size of the cache.
+
+        :return: dict
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+            }
+
+
+result_cache = ResultCache(max_entries=int(os.environ.get('RESULT_CACHE_ENTRIES', 10000)),
+                           max_bytes=int(os.environ.get('RESULT_CACHE_BYTES', 64 * 1024 * 1024)),
+                           ttl=float(os.environ.get('RESULT_CACHE_TTL', 3600)))
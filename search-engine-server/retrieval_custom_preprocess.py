@@ -1,182 +1,480 @@
+import asyncio
+import glob
+import shutil
 import pandas as pd
 import pyterrier as pt
-import nltk
 import os
-import random
-from db.services_pymongo import documents
-from db import get_documents_for_indexing, get_documents_for_client_with_client_id
+import re
+from db import get_documents_for_client_by_clinical_id, get_documents_for_snippets, get_documents_for_indexing_cursor
+from db import get_clinical_td_matrix, get_clinical_ids
+from preprocessing import preprocess_documents
+from retrievers import RetrieverRegistry, index_version, restore_index_dir, init_terrier
+from retrievers import CUSTOM_INDEX_DIR, CONTROL_INDEX_DIR
+from result_cache import result_cache
+from snippet_store import SnippetStore
+from executor import scoring_executor, hydration_executor
+from indexing_progress import IndexingProgress
+from native_engine import NativeIndex
+from lexicon_table import LexiconTable
+from sharded_index import ShardedIndex, SHARD_COUNT
+from query_reduction import QueryReducer
 from stopwords import custom_stopword_list
-from nltk import word_tokenize
-from tqdm import tqdm
 
-nltk.download('punk')
 
-
-''' Indexing and evaluation of the search engine model '''
+''' Indexing and retrieval of the search engine model, see evaluation_runner.py for its evaluation '''
 
 # First we need to add pip install python-terrier to the requirements.txt
+# Nothing is initialised on import: call load_indexes() (server.py does it on startup) before retrieving documents.
 
-pt.init()
 
+# First we create the index (CUSTOM_INDEX_DIR and CONTROL_INDEX_DIR are defined in retrievers.py)
 
-# First we create the index
+NATIVE_INDEX_DIR = "./native_index_custom"
+SHARDED_INDEX_DIR = "./native_index_custom_shards"
 
-def custom_preprocess(text):
-    custom_stopword = custom_stopword_list()
-    toks = word_tokenize(text)  # tokenize
-    toks = [t for t in toks if t.lower() not in custom_stopword]  # remove stop words
-    return ' '.join(toks)  # combine toks back into a string
+# Number of threads Terrier indexes with. Each thread builds its own index in memory and they are merged at the end.
+INDEXING_THREADS = int(os.environ.get('INDEXING_THREADS', os.cpu_count() or 1))
 
 
-def doc_custom_workaround():
-    """
-    returns a dataframe of 5k documents and their clinical_id
+def control_documents(docs):
     """
-    n_docs = 5000
-    corpus = random.sample(list(documents.find({}, {"clinical_id": 1, "raw_text": 1})), n_docs)
-
-    docs = pd.DataFrame(corpus)
-    docs = docs[['clinical_id', 'raw_text']]
-    docs.rename(columns={'clinical_id': 'docno', 'raw_text': 'text'}, inplace=True)
-
-    docs_custom = docs.copy()
-    docs_custom['text2'] = ''
-
-    for i in tqdm(range(len(docs_custom))):
-        text = docs_custom.iloc[i].text
-        removed = custom_preprocess(text)
-        docs_custom.loc[i, 'text2'] = removed
+    Renames the database documents (clinical_id, raw_text) to the {'docno', 'text'} dicts expected by
+    pt.IterDictIndexer, without any preprocessing.
 
-    docs_custom = docs_custom.drop(['text'], axis=1)
-    docs_custom = docs_custom.rename(columns={"text2": "text"})
+    :param docs: iterable - e.g. a database cursor over clinical_id and raw_text
+    :return: generator(dict)
+    """
+    for doc in docs:
+        yield {'docno': doc['clinical_id'], 'text': doc.get('raw_text') or ''}
 
-    docs_custom.to_csv('docs_custom.csv')
 
-    return docs_custom
+def build_index(index_dir: str, docs, label: str):
+    """
+    Streams an iterable of {'docno', 'text'} dicts into a new index at index_dir with INDEXING_THREADS indexing
+    threads. Only the documents of the current cursor batches and the indexer's in-memory postings are held at any
+    time. Prints the number of documents per second and the peak RSS while indexing.
+
+    :param index_dir: str
+    :param docs: iterable
+    :param label: str
+    :return: IndexRef
+    """
+    print(f"Creating new index at {index_dir} with {INDEXING_THREADS} indexing thread(s)")
+    progress = IndexingProgress(docs, label)
+    # No stopwords are removed by Terrier: the custom documents were filtered by the preprocessing, the control
+    # documents keep every term. Terrier only tokenizes and stems.
+    indexer = pt.IterDictIndexer(index_dir, stopwords=None, threads=INDEXING_THREADS)
+    index = indexer.index(iter(progress))
+    report = progress.report()
+    print(f"Indexed {report['docs']} documents into {index_dir} in {report['seconds']}s "
+          f"({report['docs_per_sec']} docs/sec, peak RSS {report['peak_rss_mb']} MB)")
+    return index
 
 
 def indexing_custom():
     """
     Creates the index using the dynamic stopword list.
-    """
 
-    docs_custom = pd.read_csv('docs_custom.csv')
+    The whole collection is streamed from the database, preprocessed across a pool of processes and fed straight into
+    the indexer, without going through a dataframe or csv file.
+    """
 
-    index_dir = "./pd_index_custom_workaround"
+    index_dir = CUSTOM_INDEX_DIR
 
     if os.path.isdir(index_dir):
         print(f"Loading existing index at {index_dir}")
-        custom_index = pt.IndexFactory.of("./pd_index_custom_workaround/data.properties")
-    else:
-        print(f"Creating new index at {index_dir}")
-        pd_indexer_custom = pt.DFIndexer(index_dir,
-                                         stopwords=None)  # We do not remove any more stopwords as they were removed in the creation of the docs_custom dataframe, we only tokenizer and stem;
-        custom_index = pd_indexer_custom.index(docs_custom['text'], docs_custom['docno'])
+        return pt.IndexFactory.of(os.path.join(index_dir, "data.properties"))
 
-    return custom_index
+    docs_custom = preprocess_documents(get_documents_for_indexing_cursor())  # generator of {'docno', 'text'};
+    return build_index(index_dir, docs_custom, "custom index")
 
 
 def indexing_control():
     """
     Creates the control index, used for evaluation purposes
-    """
-
-    # custom_stopword = custom_stopword_list()
 
-    docs = get_documents_for_indexing()  # Provides a dataframe with all documents and their clinical_id to index;
-    docs.rename(columns={'clinical_id': 'docno', 'raw_text': 'text'}, inplace=True)
+    The raw documents are streamed from the database into the indexer.
+    """
 
-    index_dir = "./pd_index_control_workaround"
+    index_dir = CONTROL_INDEX_DIR
 
     if os.path.isdir(index_dir):
         print(f"Loading existing index at {index_dir}")
-        control_index = pt.IndexFactory.of("./pd_index_control_workaround/data.properties")
-    else:
-        print(f"Creating new index at {index_dir}")
-        pd_indexer_control = pt.DFIndexer(index_dir, stopwords=None)  # Creates the custom indexer;
-        control_index = pd_indexer_control.index(docs['text'], docs['docno'])
+        return pt.IndexFactory.of(os.path.join(index_dir, "data.properties"))
 
-    return control_index
+    docs_control = control_documents(get_documents_for_indexing_cursor())  # generator of {'docno', 'text'};
+    return build_index(index_dir, docs_control, "control index")
 
 
-custom_index = indexing_custom()  # Creates the index that will be used in the BM-25 retrieval model
-control_index = indexing_control()  # Created the control index
+def load_snippet_store(index_dir: str):
+    """
+    Loads the snippet store kept in the index directory, building it first from the documents of the index if it does
+    not exist yet (i.e. right after the index was built).
+
+    :param index_dir: str
+    :return: SnippetStore
+    """
+    store = SnippetStore(index_dir)
+    if not store.exists():
+        print(f"Creating snippet store at {index_dir}")
+        index = pt.IndexFactory.of(os.path.join(index_dir, "data.properties"))
+        meta = index.getMetaIndex()
+        docnos = [meta.getItem("docno", docid) for docid in range(index.getCollectionStatistics().getNumberOfDocuments())]
+        store.build(get_documents_for_snippets(docnos))
+    store.load()
+    return store
+
+
+def load_lexicon_table(index_dir: str):
+    """
+    Loads the lexicon table of the current version of the index in index_dir, copying it from the Terrier lexicon first
+    if it does not exist yet. Tables of previous versions are deleted (searches still reading them keep their mapping).
 
+    :param index_dir: str
+    :return: LexiconTable
+    """
+    table = LexiconTable(f"{index_dir}.lexicon-{index_version(index_dir)}")
+    if not table.exists():
+        print(f"Creating lexicon table at {table.directory}")
+        table.build(pt.IndexFactory.of(os.path.join(index_dir, "data.properties")), index_version(index_dir))
+    table.load()
+    for table_dir in glob.glob(f"{index_dir}.lexicon-*"):
+        if table_dir != table.directory:
+            shutil.rmtree(table_dir, ignore_errors=True)
+    return table
+
+
+def native_documents():
+    """
+    Reads the term-document matrix of the custom model and returns its documents x terms matrix, its terms and the
+    clinical_id of each row, leaving out the rows of documents that are not in the database. Returns None if the
+    term-document matrix has not been calculated yet (see data_processing.py).
 
-async def retrieval_model_custom(query: str):
+    :return: tuple(csr_matrix, list, list) | None
     """
-    Processes query from user and returns relevant documents
+    matrix = get_clinical_td_matrix()
+    doc_ids = matrix.doc_ids
+    if not doc_ids:
+        return None
+    clinical_ids = get_clinical_ids(doc_ids)  # the matrix rows are keyed by database _id
+    rows = [row for row, doc_id in enumerate(doc_ids) if doc_id in clinical_ids]
+    return matrix.matrix[rows], matrix.terms, [clinical_ids[doc_ids[row]] for row in rows]
 
-    :param query: str
-    :return: list(documents)
+
+def indexing_native():
     """
+    Loads the in-process (numpy) index of the custom model, building it first from the term-document matrix if it
+    does not exist. The inferred stopwords are left out, as in the custom Terrier index. Returns None if the
+    term-document matrix has not been calculated yet (see data_processing.py).
 
-    bm25_dynamic = pt.BatchRetrieve(custom_index, wmodel="BM25",
-                                    num_results=1000)  # Here we create the retrieval BM25 retrieval model;
-    res_dynamic = bm25_dynamic.transform(
-        query)  # Here our documents are scored based on the BM25 model and the input query;
+    The native index is a snapshot of the term-document matrix: delete NATIVE_INDEX_DIR to rebuild it.
 
-    results = res_dynamic.loc[0:19,
-              'docno'].tolist()  # Returns a list with the clinical_ids of the first 20 documents that scored the highest;
+    :return: NativeIndex | None
+    """
+    native = NativeIndex(NATIVE_INDEX_DIR)
+    if not native.exists():
+        documents = native_documents()
+        if documents is None:
+            print("No term-document matrix, the native engine is not available")
+            return None
+        print(f"Creating native index at {NATIVE_INDEX_DIR}")
+        native.build(*documents, exclude=custom_stopword_list())
+    native.load()
+    return native
+
+
+def indexing_sharded():
+    """
+    Loads the sharded native index of the custom model and starts its worker processes, building it first (one
+    process per shard) from the term-document matrix if it does not exist with SHARD_COUNT shards. Returns None if
+    sharding is turned off (SHARD_COUNT below 2) or the term-document matrix has not been calculated yet.
 
-    return await get_documents_for_client_with_client_id(results)
+    Like the native index, it is a snapshot of the term-document matrix: delete SHARDED_INDEX_DIR to rebuild it.
 
+    :return: ShardedIndex | None
+    """
+    if SHARD_COUNT < 2:
+        return None
+    sharded = ShardedIndex(SHARDED_INDEX_DIR)
+    if not sharded.exists(SHARD_COUNT):
+        documents = native_documents()
+        if documents is None:
+            print("No term-document matrix, the sharded engine is not available")
+            return None
+        print(f"Creating sharded index at {SHARDED_INDEX_DIR} with {SHARD_COUNT} shards")
+        sharded.build(*documents, n_shards=SHARD_COUNT, exclude=custom_stopword_list())
+    sharded.load()
+    return sharded
+
+
+# Pagination limits for the client facing retrieval. Terrier is only asked for as many rows as the requested page
+# needs, rounded up to a multiple of DEPTH_STEP so that a handful of retrievers cover every page. The rows between the
+# end of the page and the rounded depth are the only extra rows fetched, i.e. at most DEPTH_STEP - 1.
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+DEPTH_STEP = 20
+MAX_DEPTH = 1000
+
+# Retrievers shared by every request, so that they reuse the same Terrier manager and weighting model
+retriever_registry = RetrieverRegistry()
+retriever_registry.add_listener(result_cache.invalidate_index)  # cached results of a rebuilt index are dropped
+
+# Retrievers created up front for every index, and again whenever an index is replaced
+WARM_CONFIGS = [("BM25", DEFAULT_PAGE_SIZE), ("BM25", 1000), ("TF_IDF", 1000)]
+
+# Title, url and description of every indexed document, so that results are hydrated without a database call. The
+# documents of the delta indexes (see delta_index.py) have their own stores until they are merged.
+snippet_stores = dict()
+delta_snippet_stores = dict()
+
+# Scoring engines a request can choose from: the Terrier retrievers, the in-process numpy index or the sharded numpy
+# index searched by worker processes (custom model only)
+ENGINES = ("terrier", "native", "sharded")
+# Score native engine queries with MaxScore pruning: the same results from fewer postings, see benchmark.py
+NATIVE_PRUNING = os.environ.get('NATIVE_PRUNING', '0') == '1'
+native_indexes = dict()
+sharded_indexes = dict()
+
+# Memory-mapped copy of the lexicon of each index, for the query term statistics of /terms and the query reduction. It
+# is copied from the main index, so the documents of a delta index are counted once they are merged.
+lexicon_tables = dict()
+
+# Inferred stopword removal and IDF query reduction of the custom model queries, see QUERY_MAX_TERMS
+query_reducer = QueryReducer(lexicon_tables, native_indexes, sharded_indexes)
+
+
+def load_indexes():
+    """
+    Starts Terrier, loads (or builds) the custom and control indexes with their snippet stores and lexicon tables and
+    creates the retrievers used by the server and the evaluation.
 
-async def retrieval_model_control(query: str):
+    :return: None
     """
-    Processes query from user and returns relevant documents
+    init_terrier()
 
-    :param query: str
-    :return: list(documents)
+    restore_index_dir(CUSTOM_INDEX_DIR)
+    restore_index_dir(CONTROL_INDEX_DIR)
+
+    custom_index = indexing_custom()  # Creates the index that will be used in the BM-25 retrieval model
+    control_index = indexing_control()  # Created the control index
+
+    snippet_stores['custom'] = load_snippet_store(CUSTOM_INDEX_DIR)
+    snippet_stores['control'] = load_snippet_store(CONTROL_INDEX_DIR)
+
+    retriever_registry.register_index('custom', custom_index, index_version(CUSTOM_INDEX_DIR))
+    retriever_registry.register_index('control', control_index, index_version(CONTROL_INDEX_DIR))
+    retriever_registry.warm(WARM_CONFIGS)
+
+    lexicon_tables['custom'] = load_lexicon_table(CUSTOM_INDEX_DIR)
+    lexicon_tables['control'] = load_lexicon_table(CONTROL_INDEX_DIR)
+
+    native = indexing_native()
+    if native is not None:
+        native_indexes['custom'] = native
+    sharded = indexing_sharded()
+    if sharded is not None:
+        sharded_indexes['custom'] = sharded
+
+
+def retrieval_depth(k: int, offset: int):
     """
+    Returns the number of results Terrier has to score and return to serve the page [offset, offset + k).
 
-    bm25_dynamic = pt.BatchRetrieve(control_index, wmodel="BM25",
-                                    num_results=1000)  # Here we create the retrieval BM25 retrieval model;
-    res_dynamic = bm25_dynamic.transform(
-        query)  # Here our documents are scored based on the BM25 model and the input query;
+    :param k: int
+    :param offset: int
+    :return: int
+    """
+    depth = -(-(offset + k) // DEPTH_STEP) * DEPTH_STEP  # round up to the next multiple of DEPTH_STEP
+    return min(depth, MAX_DEPTH)
+
+
+async def rank_documents(index_name: str, query: str, k: int = DEFAULT_PAGE_SIZE, offset: int = 0,
+                         engine: str = "terrier"):
+    """
+    Scores the query with BM25 on the named index and returns the clinical_ids of the page [offset, offset + k).
+    The query is scored by the Terrier retriever of the index, by its native (numpy) index when engine is "native", or
+    by its sharded native index when engine is "sharded".
+    Rankings are served from the result cache when the same query was already retrieved deep enough.
 
-    results = res_dynamic.loc[0:19,
-              'docno'].tolist()  # Returns a list with the clinical_ids of the first 20 documents that scored the highest;
+    :param index_name: str
+    :param query: str
+    :param k: int
+    :param offset: int
+    :param engine: str
+    :return: list
+    """
+    if offset >= MAX_DEPTH or not query.strip():
+        return []
+    depth = retrieval_depth(k, offset)
+    if engine == "native":
+        native = native_indexes[index_name]
+        version, wmodel = native.stats.get('version', ''), "native:BM25"
+    elif engine == "sharded":
+        sharded = sharded_indexes[index_name]
+        version, wmodel = sharded.version, "sharded:BM25"
+    else:
+        version, wmodel = retriever_registry.versions[index_name], "BM25"
+
+    docnos = result_cache.get(query, index_name, version, wmodel, depth)
+    if docnos is None:
+        if engine == "native":
+            if NATIVE_PRUNING:
+                docnos, _, _ = await scoring_executor.run(native.search_maxscore, query, "BM25", depth)
+            else:
+                docnos, _ = await scoring_executor.run(native.search, query, "BM25", depth)
+        elif engine == "sharded":
+            docnos, _ = await scoring_executor.run(sharded.search, query, "BM25", depth)
+        else:
+            bm25 = retriever_registry.get(index_name, "BM25", depth)  # BM25 model sized to the page;
+            res = await scoring_executor.run(bm25.transform,
+                                             query)  # Here our documents are scored based on the BM25 model and the input query;
+            docnos = res['docno'].tolist()  # Results are returned by Terrier in rank order;
+        result_cache.put(query, index_name, version, wmodel, depth, docnos)
+
+    return docnos[offset:offset + k]
+
+
+async def hydrate_documents(index_name: str, docnos: list):
+    """
+    Returns the client information of the documents in rank order. Documents are read from the snippet store of the
+    index, then from the store of its delta index; only documents missing from both are looked up in the database.
+
+    :param index_name: str
+    :param docnos: list
+    :return: list(documents)
+    """
+    records = snippet_stores[index_name].lookup(docnos)
+    delta_store = delta_snippet_stores.get(index_name)
+    if delta_store is not None and None in records:
+        records = [delta_record if record is None else record
+                   for record, delta_record in zip(records, delta_store.lookup(docnos))]
+    missing = [docno for docno, record in zip(docnos, records) if record is None]
+    if missing:
+        found = await hydration_executor.run(get_documents_for_client_by_clinical_id, missing)
+        records = [found.get(docno) if record is None else record for docno, record in zip(docnos, records)]
+    return [record for record in records if record is not None]
+
+
+async def retrieval_model_custom(query: str, k: int = DEFAULT_PAGE_SIZE, offset: int = 0, engine: str = "terrier"):
+    """
+    Processes query from user and returns relevant documents
 
-    return await get_documents_for_client_with_client_id(results)
+    :param query: str
+    :param k: int: number of documents to return
+    :param offset: int: rank of the first document to return
+    :param engine: str: "terrier", "native" or "sharded"
+    :return: list(documents)
+    """
+    # The reduction looks terms up in the index, so it runs on the scoring pool like the scoring itself
+    query = await scoring_executor.run(query_reducer.reduce, 'custom', query, engine=engine)
+    results = await rank_documents('custom', query, k, offset, engine)
 
+    return await hydrate_documents('custom', results)
 
-# Now we get the relevancy files and the topics
 
-def evaluate():
+async def retrieval_model_control(query: str, k: int = DEFAULT_PAGE_SIZE, offset: int = 0):
     """
-    Compare the results of using standard and custom stopword list
+    Processes query from user and returns relevant documents
 
-    :return: a table of evaluation metric results. The first row(0) is the values for standard stopwords
+    :param query: str
+    :param k: int: number of documents to return
+    :param offset: int: rank of the first document to return
+    :return: list(documents)
     """
+    results = await rank_documents('control', query, k, offset)
 
-    dataset = pt.get_dataset("irds:clinicaltrials/2021/trec-ct-2021")
-    topics = dataset.get_topics()  # we get the topics in a format easy to use with the pyterrier evaluator framework
-    qrels = dataset.get_qrels()  # we do the same with the relevancy files
+    return await hydrate_documents('control', results)
 
-    bm25_custom = pt.BatchRetrieve(custom_index, wmodel="BM25",
-                                   num_results=1000)  # we create a bm-25 retrieval model that uses our custom list of stopwords
-    bm25_control = pt.BatchRetrieve(control_index, wmodel="BM25",
-                                    num_results=1000)  # now we create a model that we will use as control
 
-    tf_idf_custom = pt.BatchRetrieve(custom_index, wmodel="TF_IDF", num_results=1000)
+# Batch retrieval: queries scored per BatchRetrieve.transform call, number of chunks scored at the same time (the rest
+# of the scoring pool stays free for interactive queries) and weighting models a batch may ask for
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 16))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 2))
+BATCH_WMODELS = ("BM25", "TF_IDF")
 
-    # Dataframe to show us the different evaluation metrics on the standard and custom stopword list
 
-    experiment = pt.Experiment([bm25_custom, bm25_control], topics, qrels,
-                               ['map', 'P_5', 'recall_5', 'num_rel', 'num_rel_ret'])
+def prepare_batch_query(index_name: str, query: str):
+    """
+    Cleans a batch query the same way /data does: non-word characters become spaces and, for the custom index, the
+    query is reduced by query_reducer.
+
+    :param index_name: str
+    :param query: str
+    :return: str
+    """
+    query = re.sub(r'\W+', ' ', query).strip()
+    return query_reducer.reduce('custom', query) if index_name == 'custom' else query
 
-    sum_p_r = experiment['P_5'] + experiment['recall_5']
-    stopword_list = ['custom', 'standard']
 
-    experiment.insert(0, 'stopword_list', stopword_list)
-    experiment.insert(5, 'P+R', sum_p_r)
+def prepare_batch_topics(index_name: str, queries: list):
+    """
+    Returns the (qid, query) pairs of a batch with their qid as a string and their query cleaned by
+    prepare_batch_query. Runs on the scoring pool, as the query reduction looks terms up in the index.
 
-    # Dataframe of the evaluation metrics of BM25 and TF-IDF
+    :param index_name: str
+    :param queries: list
+    :return: list(tuple(str, str))
+    """
+    return [(str(qid), prepare_batch_query(index_name, query)) for qid, query in queries]
 
-    model_eval = pt.Experiment([bm25_custom, tf_idf_custom], topics, qrels,
-                               ['ndcg', 'Rprec', 'num_rel', 'num_rel_ret'])
 
-    pd.set_option('display.max_columns', None)
+def score_topics(retriever, topics: pd.DataFrame):
+    """
+    Scores a multi-row topics dataframe (qid, query) with one transform call and returns the ranked docnos and scores
+    of every qid, in the order of the topics.
 
-    return experiment, model_eval
+    :param retriever: BatchRetrieve
+    :param topics: DataFrame
+    :return: list(tuple(qid, docnos, scores))
+    """
+    res = retriever.transform(topics)
+    ranked = {qid: group for qid, group in res.groupby('qid', sort=False)}
+    results = list()
+    for qid in topics['qid']:
+        group = ranked.get(qid)
+        if group is None:
+            results.append((qid, [], []))
+        else:
+            group = group.sort_values('rank')
+            results.append((qid, group['docno'].tolist(), group['score'].round(4).tolist()))
+    return results
+
+
+async def rank_batch(index_name: str, queries: list, k: int = MAX_DEPTH, wmodel: str = "BM25"):
+    """
+    Ranks many (qid, query) pairs on the named index. Queries are scored BATCH_CHUNK_SIZE at a time, each chunk as one
+    multi-row BatchRetrieve.transform on the scoring pool, with at most BATCH_CONCURRENCY chunks in flight. Yields a
+    (qid, docnos, scores) tuple for every query, chunk by chunk as they finish. Empty queries yield no results.
+
+    The retriever scores retrieval_depth(k, 0) results, so that every k shares one of a handful of cached retrievers,
+    and the rankings are cut to k. Chunks still in flight are cancelled when the generator is closed early, e.g. when
+    the client disconnects.
+
+    :param index_name: str
+    :param queries: list
+    :param k: int
+    :param wmodel: str
+    :return: async generator(tuple)
+    """
+    retriever = retriever_registry.get(index_name, wmodel, retrieval_depth(k, 0))
+    topics = await scoring_executor.run(prepare_batch_topics, index_name, queries)
+    for qid, query in topics:
+        if not query:
+            yield qid, [], []
+    topics = [(qid, query) for qid, query in topics if query]
+    chunks = [pd.DataFrame(topics[start:start + BATCH_CHUNK_SIZE], columns=['qid', 'query'])
+              for start in range(0, len(topics), BATCH_CHUNK_SIZE)]
+
+    running = set()
+    try:
+        while chunks or running:
+            while chunks and len(running) < BATCH_CONCURRENCY:
+                running.add(asyncio.ensure_future(scoring_executor.run(score_topics, retriever, chunks.pop(0))))
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                for qid, docnos, scores in task.result():
+                    yield qid, docnos[:k], scores[:k]
+    finally:
+        # on an error, a cancellation or an early close, chunks still queued on the scoring pool are dropped
+        for pending in running:
+            pending.cancel()
@@ -27,7 +27,7 @@ def indexing_custom():
         custom_index = pt.IndexFactory.of("./pd_index_custom/data.properties")
     else:
         print(f"Creating new index at {index_dir}")
-        pd_indexer_custom = pt.DFIndexer(index_dir, stopwords=custom_stopword)  # Creates the custom indexer;
+        pd_indexer_custom = pt.DFIndexer(index_dir, stopwords=list(custom_stopword))  # Creates the custom indexer;
         custom_index = pd_indexer_custom.index(docs['text'], docs['docno'])
 
     return custom_index
@@ -50,7 +50,7 @@ def indexing_control():
         control_index = pt.IndexFactory.of("./pd_index_control/data.properties")
     else:
         print(f"Creating new index at {index_dir}")
-        pd_indexer_control = pt.DFIndexer(index_dir, stopwords=standard_stopword)  # Creates the custom indexer;
+        pd_indexer_control = pt.DFIndexer(index_dir, stopwords=list(standard_stopword))  # Creates the custom indexer;
         control_index = pd_indexer_control.index(docs['text'], docs['docno'])
 
     return control_index
@@ -76,7 +76,7 @@ async def retrieval_model(query: str):
     results = res_dynamic.loc[0:19,
               'docno'].tolist()  # Returns a list with the clinical_ids of the first 20 documents that scored the highest;
 
-    return await get_documents_for_client_with_client_id(results)
+    return get_documents_for_client_with_client_id(results)
 
 
 def evaluate():
@@ -0,0 +1,158 @@
+import pyterrier as pt
+import os
+
+''' Registry of ready-to-use PyTerrier retrievers shared by all requests '''
+
+# Directories of the Terrier indexes of the custom model (inferred stopwords removed) and of the control model, read by
+# the server and by the evaluation runs
+CUSTOM_INDEX_DIR = "./pd_index_custom_workaround"
+CONTROL_INDEX_DIR = "./pd_index_control_workaround"
+
+
+def init_terrier():
+    """
+    Starts the JVM used by PyTerrier if it is not running yet.
+
+    :return: None
+    """
+    if not pt.started():
+        pt.init()
+
+
+def index_version(index_dir: str):
+    """
+    Returns a string that changes whenever the Terrier index in index_dir is rebuilt, based on the modification time of
+    its data.properties file.
+
+    :param index_dir: str
+    :return: str
+    """
+    try:
+        return str(os.stat(os.path.join(index_dir, 'data.properties')).st_mtime_ns)
+    except FileNotFoundError:
+        return ''
+
+
+def restore_index_dir(index_dir: str):
+    """
+    Moves the previous version of an index back in place if a merge was interrupted after the index directory was moved
+    aside and before the merged index replaced it.
+
+    :param index_dir: str
+    :return: None
+    """
+    previous_dir = f"{index_dir}.old"
+    if not os.path.isdir(index_dir) and os.path.isdir(previous_dir):
+        print(f"Restoring {index_dir} from {previous_dir}")
+        os.rename(previous_dir, index_dir)
+
+
+def concurrent_index(index):
+    """
+    Returns the index ready to be searched by several threads at once, as PyTerrier prepares it for a BatchRetrieve
+    with threads > 1: an IndexRef is opened, and the lexicon, postings and metadata readers of an index on disk are
+    replaced by thread-safe ones. A MultiIndex is returned as it is, its parts must be made concurrent before they are
+    combined.
+
+    :param index: IndexRef | Index
+    :return: Index
+    """
+    if isinstance(index, pt.autoclass("org.terrier.realtime.multi.MultiIndex")):
+        return index
+    if not hasattr(index, 'getLexicon'):
+        index = pt.IndexFactory.of(index)  # an IndexRef returned by the indexer
+    concurrent = pt.autoclass("org.terrier.structures.concurrent.ConcurrentIndexUtils")
+    if not concurrent.isConcurrent(index):
+        concurrent.makeConcurrentForRetrieval(index)
+    return index
+
+
+class RetrieverRegistry:
+    """
+    Holds the loaded indexes and the BatchRetrieve pipelines built on top of them, so that the Java-side manager and
+    weighting model are set up once instead of on every request.
+
+    The retrievers and indexes are shared by every thread of the scoring pool, so every index is made concurrent (see
+    concurrent_index) when it is registered.
+
+    Attributes
+
+    indexes: dict - the loaded indexes keyed by name (e.g. 'custom', 'control'), safe for concurrent retrieval
+
+    versions: dict - version string of each loaded index keyed by name
+
+    retrievers: dict - BatchRetrieve instances keyed by (index name, wmodel, num_results)
+
+    listeners: list - callables notified with the index name whenever an index is replaced
+
+    Methods
+
+    register_index: None - adds a loaded index to the registry under a name
+
+    add_listener: None - registers a callable that is notified when an index is replaced
+
+    get: BatchRetrieve - returns the retriever for (index name, wmodel, num_results), creating it on first use
+
+    warm: None - creates the retrievers for a list of (wmodel, num_results) pairs for every registered index
+
+    """
+    def __init__(self):
+        self.indexes: dict = dict()
+        self.versions: dict = dict()
+        self.retrievers: dict = dict()
+        self.listeners: list = list()
+
+    def register_index(self, name: str, index, version: str = ''):
+        """
+        Adds a loaded index to the registry, made safe for concurrent retrieval. Any retriever built on a previous
+        index with the same name is dropped and the listeners are notified.
+
+        :param name: str
+        :param index: IndexRef | Index
+        :param version: str
+        :return: None
+        """
+        replaced = name in self.indexes
+        self.indexes[name] = concurrent_index(index)
+        self.versions[name] = version
+        self.retrievers = {key: retriever for key, retriever in self.retrievers.items() if key[0] != name}
+        if replaced:
+            for listener in self.listeners:
+                listener(name)
+
+    def add_listener(self, listener):
+        """
+        Registers a callable that is called with the index name whenever a registered index is replaced.
+
+        :param listener: callable
+        :return: None
+        """
+        self.listeners.append(listener)
+
+    def get(self, name: str, wmodel: str = "BM25", num_results: int = 1000):
+        """
+        Returns the retriever for the given index name, weighting model and number of results. The retriever is created
+        the first time it is requested and reused afterwards.
+
+        :param name: str
+        :param wmodel: str
+        :param num_results: int
+        :return: BatchRetrieve
+        """
+        key = (name, wmodel, num_results)
+        retriever = self.retrievers.get(key)
+        if retriever is None:
+            retriever = pt.BatchRetrieve(self.indexes[name], wmodel=wmodel, num_results=num_results)
+            self.retrievers[key] = retriever
+        return retriever
+
+    def warm(self, configs: list):
+        """
+        Creates the retrievers for every registered index and each (wmodel, num_results) pair in configs.
+
+        :param configs: list
+        :return: None
+        """
+        for name in self.indexes:
+            for wmodel, num_results in configs:
+                self.get(name, wmodel, num_results)
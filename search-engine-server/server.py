@@ -0,0 +1,170 @@
+from quart import Quart, request, Response
+from quart_cors import route_cors
+from retrieval_custom_preprocess import retrieval_model_custom, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from retrieval_custom_preprocess import rank_batch, MAX_DEPTH, BATCH_WMODELS, ENGINES, native_indexes
+from retrieval_custom_preprocess import lexicon_tables, sharded_indexes
+from db import get_query_list_for_client
+from executor import ExecutorSaturated, hydration_executor
+from result_cache import result_cache
+import startup
+import delta_index
+import json
+import os
+import re
+
+''' Quart application of the search engine, started by main.py '''
+
+# Create engine
+app = Quart(__name__)
+
+# Largest number of queries accepted by one /batch request
+BATCH_MAX_QUERIES = int(os.environ.get('BATCH_MAX_QUERIES', 1000))
+
+
+# Load the indexes and warm them up in the background once the server is listening, see /ready. Newly ingested
+# documents are then added to the indexes by the delta index task.
+@app.before_serving
+async def start_services():
+    app.add_background_task(startup.start)
+    app.add_background_task(delta_index.run)
+
+
+# Liveness probe: the process is up and its startup has not failed
+@app.route('/live')
+def live():
+    status = 200 if startup.state["live"] else 503
+    return json.dumps({"live": startup.state["live"], "stage": startup.state["stage"]}), status
+
+
+# Readiness probe: indexes are loaded and the scoring path is warm
+@app.route('/ready')
+def ready():
+    status = 200 if startup.state["ready"] else 503
+    return json.dumps(startup.state), status
+
+
+#  Add a test route - for debug purposes
+@app.route('/test')
+@route_cors(allow_origin="*")
+def home_route():
+    return {"test": "again"}
+
+
+# Add a route which accepts a user query and returns a ranked set of results
+# Either /data?<query> or
+# /data?q=<query>&k=<page size>&offset=<rank of first result>&engine=<terrier | native | sharded>
+@app.route('/data')
+@route_cors(allow_origin="*")
+async def data():
+    if not startup.state["ready"]:
+        return json.dumps({"error": "server is starting"}), 503, {"Access-Control-Allow-Origin": "*", "Retry-After": "5"}
+
+    if 'q' in request.args:
+        query_string = request.args.get('q', '')
+        k = min(max(request.args.get('k', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        engine = request.args.get('engine', 'terrier')
+    else:
+        query_string = request.query_string.decode("utf-8")
+        k = DEFAULT_PAGE_SIZE
+        offset = 0
+        engine = 'terrier'
+    query_string = re.sub(r'\W+', ' ', query_string)
+    if engine not in ENGINES or (engine == 'native' and 'custom' not in native_indexes) \
+            or (engine == 'sharded' and 'custom' not in sharded_indexes):
+        return json.dumps({"error": f"engine must be one of {ENGINES} and available"}), 400, \
+            {"Access-Control-Allow-Origin": "*"}
+
+    # code to process query and determine results
+    try:
+        results = list(await retrieval_model_custom(query_string, k, offset, engine))
+    except ExecutorSaturated as e:
+        # Shed load instead of queueing without limit; the client can retry shortly
+        return json.dumps({"error": str(e)}), 503, {"Access-Control-Allow-Origin": "*", "Retry-After": "1"}
+
+    # return response to the client side
+    return json.dumps(results), 200, {"Access-Control-Allow-Origin": "*"}
+
+
+# Rank many queries in one call, for evaluation and offline analysis. The body is
+# {"queries": [{"qid": ..., "query": ...} | "<query>", ...], "k": <results per query>, "index": "custom" | "control",
+#  "wmodel": "BM25" | "TF_IDF"}, with unique qids. The response is NDJSON, one {"qid", "docnos", "scores"} line per
+# query, streamed as the queries are scored.
+@app.route('/batch', methods=['POST'])
+@route_cors(allow_origin="*")
+async def batch():
+    if not startup.state["ready"]:
+        return json.dumps({"error": "server is starting"}), 503, {"Access-Control-Allow-Origin": "*", "Retry-After": "5"}
+
+    body = await request.get_json(force=True, silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('queries'), list) \
+            or type(body.get('k', MAX_DEPTH)) is not int:
+        error = "expected a JSON object with a list of queries and an integer k"
+        return json.dumps({"error": error}), 400, {"Access-Control-Allow-Origin": "*"}
+
+    queries = [(entry.get('qid', i), str(entry.get('query', ''))) if isinstance(entry, dict) else (i, str(entry))
+               for i, entry in enumerate(body['queries'])]
+    k = min(max(body.get('k', MAX_DEPTH), 1), MAX_DEPTH)
+    index_name = body.get('index', 'custom')
+    wmodel = body.get('wmodel', 'BM25')
+    if not queries or len(queries) > BATCH_MAX_QUERIES or index_name not in ('custom', 'control') \
+            or wmodel not in BATCH_WMODELS:
+        error = f"expected 1 to {BATCH_MAX_QUERIES} queries, index custom or control and wmodel in {BATCH_WMODELS}"
+        return json.dumps({"error": error}), 400, {"Access-Control-Allow-Origin": "*"}
+    if len({str(qid) for qid, query in queries}) < len(queries):
+        return json.dumps({"error": "qids must be unique"}), 400, {"Access-Control-Allow-Origin": "*"}
+
+    async def results():
+        ranked = rank_batch(index_name, queries, k, wmodel)
+        try:
+            async for qid, docnos, scores in ranked:
+                yield (json.dumps({"qid": qid, "docnos": docnos, "scores": scores}) + "\n").encode("utf-8")
+        except ExecutorSaturated as e:
+            # Headers are already sent, so the error is reported as the last line of the stream
+            yield (json.dumps({"error": str(e)}) + "\n").encode("utf-8")
+        finally:
+            # The client may disconnect mid-stream: closing the ranking cancels the chunks still in flight
+            await ranked.aclose()
+
+    return Response(results(), status=200, mimetype="application/x-ndjson",
+                    headers={"Access-Control-Allow-Origin": "*"})
+
+
+# Statistics of every term of a query, tokenized and stemmed like the index: /terms?q=<query>&index=<custom | control>
+# returns [{"_id", "name", "term", "df", "cf", "idf"}, ...] in query order. Answered from the memory-mapped lexicon
+# table without calling Terrier, so it can be called on every keystroke.
+@app.route('/terms')
+@route_cors(allow_origin="*")
+def terms():
+    index_name = request.args.get('index', 'custom')
+    if index_name not in ('custom', 'control'):
+        return json.dumps({"error": "index must be custom or control"}), 400, {"Access-Control-Allow-Origin": "*"}
+    table = lexicon_tables.get(index_name)
+    if table is None:
+        return json.dumps({"error": f"the {index_name} lexicon is not loaded yet"}), 503, \
+            {"Access-Control-Allow-Origin": "*", "Retry-After": "5"}
+
+    term_stats = table.lookup(request.args.get('q', ''))
+    for position, term in enumerate(term_stats):
+        term["_id"] = position
+    return json.dumps(term_stats), 200, {"Access-Control-Allow-Origin": "*"}
+
+
+# Hit / miss counters of the query result cache
+@app.route('/cache')
+@route_cors(allow_origin="*")
+async def cache_stats():
+    return json.dumps(result_cache.stats()), 200, {"Access-Control-Allow-Origin": "*"}
+
+
+@app.route('/queries')
+@route_cors(allow_origin="*")
+async def get_queries_list():
+    try:
+        queries_list = await hydration_executor.run(get_query_list_for_client)
+    except ExecutorSaturated as e:
+        return json.dumps({"error": str(e)}), 503, {"Access-Control-Allow-Origin": "*", "Retry-After": "1"}
+
+    # return response to the client side
+    return json.dumps(queries_list), 200, {"Access-Control-Allow-Origin": "*"}
+
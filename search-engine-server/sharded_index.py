@@ -0,0 +1,233 @@
+from multiprocessing.pool import Pool
+import json
+import os
+import shutil
+import zlib
+import numpy as np
+from scipy.sparse import csr_matrix
+from native_engine import NativeIndex, collection_statistics
+from worker_pool import process_pool
+
+''' Native index split into shards by docno hash, built in parallel and searched scatter-gather by worker processes '''
+
+# Number of shards of the sharded native index (0 or 1: no sharded index) and number of worker processes searching
+# them, by default one per shard
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 0))
+SHARD_PROCESSES = int(os.environ.get('SHARD_PROCESSES', min(max(SHARD_COUNT, 1), os.cpu_count() or 1)))
+
+SHARD_MANIFEST = 'shards.json'
+
+# Shards opened by a worker process: directory -> list(NativeIndex)
+worker_shards = dict()
+
+
+def shard_of(docno: str, n_shards: int):
+    """
+    Returns the shard of a document: the CRC32 of its docno modulo the number of shards, which is stable across
+    processes and runs (unlike hash()).
+
+    :param docno: str
+    :param n_shards: int
+    :return: int
+    """
+    return zlib.crc32(docno.encode('utf-8')) % n_shards
+
+
+def shard_dir(directory: str, shard: int):
+    """
+    Returns the directory of a shard of the sharded index saved in directory.
+
+    :param directory: str
+    :param shard: int
+    :return: str
+    """
+    return os.path.join(directory, f'shard-{shard}')
+
+
+def build_shard(directory: str, matrix: csr_matrix, terms: list, docnos: list, exclude: frozenset, collection: dict):
+    """
+    Builds one shard in a worker process, with the statistics of the whole collection.
+
+    :param directory: str
+    :param matrix: csr_matrix
+    :param terms: list
+    :param docnos: list
+    :param exclude: frozenset
+    :param collection: dict
+    :return: int
+    """
+    return NativeIndex(directory).build(matrix, terms, docnos, exclude=exclude, collection=collection)
+
+
+def open_shards(directory: str, n_shards: int):
+    """
+    Memory-maps every shard of the sharded index in the worker process. Runs once per worker, as its initializer.
+
+    :param directory: str
+    :param n_shards: int
+    :return: None
+    """
+    shards = [NativeIndex(shard_dir(directory, shard)) for shard in range(n_shards)]
+    for shard in shards:
+        shard.load()
+    worker_shards[directory] = shards
+
+
+def search_shard(directory: str, shard: int, query: str, wmodel: str, k: int):
+    """
+    Returns the docnos and scores of the k best documents of one shard, in a worker process.
+
+    :param directory: str
+    :param shard: int
+    :param query: str
+    :param wmodel: str
+    :param k: int
+    :return: tuple(list, ndarray)
+    """
+    return worker_shards[directory][shard].search(query, wmodel, k)
+
+
+class ShardedIndex:
+    """
+    A native index split into shards by the CRC32 of the docno. Every shard is a NativeIndex built with the statistics
+    of the whole collection (number of documents, average document length and document frequencies), so a document
+    gets exactly the score it gets in the unsharded index.
+
+    A query is scattered to every shard over a pool of worker processes, each holding its own memory mapping of the
+    shards, and the per-shard top k are gathered and merged into the global top k. Documents with equal scores are
+    ordered by docno, in the shards and in the merge, as they are in the unsharded index. The worker processes only
+    import this module and native_engine (see worker_pool.py).
+
+    Attributes
+
+    directory: str - the directory the shards are saved in
+
+    processes: int - number of worker processes
+
+    n_shards: int - number of shards of the saved index
+
+    version: str - changes whenever the shards are rebuilt
+
+    pool: Pool | None - the worker processes, started by load
+
+    first_shard: NativeIndex | None - the first shard, memory-mapped in this process by load for its term statistics,
+    which every shard shares
+
+    Methods
+
+    exists: bool - whether the index is saved in the directory with the given number of shards
+
+    build: int - partitions a documents x terms frequency matrix and builds the shards in parallel
+
+    load: None - starts the worker processes, which memory-map the shards, and maps the first shard
+
+    lookup: list - IDF of every distinct query term
+
+    search: tuple - docnos and scores of the top k documents over all shards
+
+    close: None - stops the worker processes
+
+    """
+    def __init__(self, directory: str, processes: int = SHARD_PROCESSES):
+        self.directory: str = directory
+        self.processes: int = processes
+        self.n_shards: int = 0
+        self.version: str = ''
+        self.pool: Pool | None = None
+        self.first_shard: NativeIndex | None = None
+
+    def exists(self, n_shards: int):
+        """
+        Returns True if the index is saved in the directory and has n_shards shards.
+
+        :param n_shards: int
+        :return: bool
+        """
+        try:
+            with open(os.path.join(self.directory, SHARD_MANIFEST), 'r') as f:
+                return json.load(f)['n_shards'] == n_shards
+        except FileNotFoundError:
+            return False
+
+    def build(self, matrix: csr_matrix, terms: list, docnos: list, n_shards: int, exclude: frozenset = frozenset()):
+        """
+        Partitions the rows of a documents x terms frequency matrix into n_shards shards by docno and builds the
+        shards in parallel processes. Returns the number of documents.
+
+        :param matrix: csr_matrix
+        :param terms: list
+        :param docnos: list
+        :param n_shards: int
+        :param exclude: frozenset
+        :return: int
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        collection = collection_statistics(matrix, terms, exclude)
+        shards = np.array([shard_of(docno, n_shards) for docno in docnos], dtype=np.int64)
+        jobs = list()
+        for shard in range(n_shards):
+            rows = np.flatnonzero(shards == shard)
+            jobs.append((shard_dir(self.directory, shard), matrix[rows], terms, [docnos[row] for row in rows], exclude,
+                         collection))
+        with process_pool(min(self.processes, n_shards)) as pool:
+            sizes = pool.starmap(build_shard, jobs)
+        with open(os.path.join(self.directory, SHARD_MANIFEST), 'w') as f:  # written last: the index is complete
+            json.dump({'n_shards': n_shards, 'docs': sizes}, f)
+        return sum(sizes)
+
+    def load(self):
+        """
+        Starts the worker processes searching the shards and memory-maps the first shard for its term statistics.
+
+        :return: None
+        """
+        with open(os.path.join(self.directory, SHARD_MANIFEST), 'r') as f:
+            self.n_shards = json.load(f)['n_shards']
+        self.version = str(os.stat(os.path.join(self.directory, SHARD_MANIFEST)).st_mtime_ns)
+        self.close()
+        self.first_shard = NativeIndex(shard_dir(self.directory, 0))
+        self.first_shard.load()
+        self.pool = process_pool(self.processes, initializer=open_shards, initargs=(self.directory, self.n_shards))
+
+    def lookup(self, query: str, wmodel: str = "BM25"):
+        """
+        Returns every distinct query term in query order with its IDF under the weighting model, None for terms not in
+        the index. Every shard has every term with the statistics of the whole collection, so the first shard answers.
+
+        :param query: str
+        :param wmodel: str
+        :return: list(tuple(str, float | None))
+        """
+        return self.first_shard.lookup(query, wmodel)
+
+    def search(self, query: str, wmodel: str = "BM25", k: int = 1000):
+        """
+        Returns the docnos and scores of the k best documents for the query over all shards, best first.
+
+        :param query: str
+        :param wmodel: str
+        :param k: int
+        :return: tuple(list, ndarray)
+        """
+        results = self.pool.starmap(search_shard, [(self.directory, shard, query, wmodel, k)
+                                                   for shard in range(self.n_shards)])
+        docnos, scores = list(), list()
+        for shard_docnos, shard_scores in results:
+            docnos.extend(shard_docnos)
+            scores.append(shard_scores)
+        if not docnos:
+            return list(), np.zeros(0, dtype=np.float64)
+        scores = np.concatenate(scores)
+        top = np.lexsort((np.array(docnos, dtype=str), -scores))[:k]  # same order as NativeIndex.top_k
+        return [docnos[position] for position in top.tolist()], scores[top]
+
+    def close(self):
+        """
+        Stops the worker processes.
+
+        :return: None
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,137 @@
+import json
+import mmap
+import numpy as np
+import os
+
+''' Memory-mapped store of the document fields shown to the client, built next to each index '''
+
+SNIPPET_DATA = 'snippets.data'
+SNIPPET_OFFSETS = 'snippets.offsets.npy'
+SNIPPET_DOCNOS = 'snippets.docnos.json'
+
+
+class SnippetStore:
+    """
+    Holds the client facing fields (_id, title, url, description) of every indexed document, so that ranked results
+    can be hydrated without a database round trip.
+
+    Records are stored as JSON one after the other in a single data file that is memory-mapped, with a numpy array of
+    byte offsets and a docno -> row dictionary to find them.
+
+    Attributes
+
+    directory: str - the directory the store is written to, normally the index directory
+
+    rows: dict - row number of each docno
+
+    offsets: ndarray | None - byte offset of each record in the data file, with the end of the file appended
+
+    data: mmap | None - the memory-mapped data file
+
+    Methods
+
+    exists: bool - whether the store files are present in the directory
+
+    build: int - writes the store from an iterable of documents, returns the number of documents written
+
+    append: int - adds documents at the end of a written store, returns the number of documents added
+
+    load: None - memory-maps the store
+
+    lookup: list - returns the records for a list of docnos in the same order, None for docnos not in the store
+
+    """
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        self.rows: dict = dict()
+        self.offsets: np.ndarray | None = None
+        self.data: mmap.mmap | None = None
+
+    def exists(self):
+        """
+        Returns True if the store files are present in the directory.
+
+        :return: bool
+        """
+        return all(os.path.isfile(os.path.join(self.directory, name))
+                   for name in (SNIPPET_DATA, SNIPPET_OFFSETS, SNIPPET_DOCNOS))
+
+    def build(self, docs):
+        """
+        Writes the store from an iterable of dicts with the keys clinical_id, _id, title, url and description.
+
+        :param docs: iterable
+        :return: int
+        """
+        return self.write(docs, list(), [0], 'wb')
+
+    def append(self, docs):
+        """
+        Adds documents (same dicts as build) at the end of a store that was already written. The store has to be
+        loaded again to see them.
+
+        :param docs: iterable
+        :return: int
+        """
+        with open(os.path.join(self.directory, SNIPPET_DOCNOS), 'r') as f:
+            docnos = json.load(f)
+        offsets = np.load(os.path.join(self.directory, SNIPPET_OFFSETS)).tolist()
+        existing = len(docnos)
+        return self.write(docs, docnos, offsets, 'ab') - existing
+
+    def write(self, docs, docnos: list, offsets: list, mode: str):
+        """
+        Writes the records of docs to the data file opened with mode, then the offsets and docnos with the new records
+        added after the given ones. Returns the total number of documents in the store.
+
+        :param docs: iterable
+        :param docnos: list
+        :param offsets: list
+        :param mode: str
+        :return: int
+        """
+        with open(os.path.join(self.directory, SNIPPET_DATA), mode) as f:
+            for doc in docs:
+                record = json.dumps({
+                    "_id": str(doc.get('_id')),
+                    "title": doc.get('title'),
+                    "url": doc.get('url', ""),
+                    "description": doc.get('description')
+                }).encode('utf-8')
+                f.write(record)
+                offsets.append(offsets[-1] + len(record))
+                docnos.append(doc['clinical_id'])
+        np.save(os.path.join(self.directory, SNIPPET_OFFSETS), np.array(offsets, dtype=np.int64))
+        with open(os.path.join(self.directory, SNIPPET_DOCNOS), 'w') as f:
+            json.dump(docnos, f)
+        return len(docnos)
+
+    def load(self):
+        """
+        Memory-maps the store so that lookups only touch the pages of the requested records.
+
+        :return: None
+        """
+        with open(os.path.join(self.directory, SNIPPET_DOCNOS), 'r') as f:
+            self.rows = {docno: row for row, docno in enumerate(json.load(f))}
+        self.offsets = np.load(os.path.join(self.directory, SNIPPET_OFFSETS), mmap_mode='r')
+        with open(os.path.join(self.directory, SNIPPET_DATA), 'rb') as f:
+            # mmap cannot map an empty file
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] > 0 else None
+
+    def lookup(self, docnos: list):
+        """
+        Returns the client records for the docnos in the same (rank) order, with None in place of docnos that are not
+        in the store.
+
+        :param docnos: list
+        :return: list
+        """
+        records = list()
+        for docno in docnos:
+            row = self.rows.get(docno)
+            if row is None:
+                records.append(None)
+            else:
+                records.append(json.loads(self.data[self.offsets[row]:self.offsets[row + 1]]))
+        return records
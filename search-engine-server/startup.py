@@ -0,0 +1,86 @@
+from retrieval_custom_preprocess import load_indexes, retriever_registry, DEFAULT_PAGE_SIZE
+from db import topics_parser
+from executor import scoring_executor
+import asyncio
+import numpy as np
+import os
+import pathlib
+import re
+import time
+
+''' Startup lifecycle of the server: load the indexes, warm the scoring path up and report readiness '''
+
+# Number of topics replayed per warm-up round, maximum number of rounds, and the relative change in p99 latency
+# between two rounds below which the scoring path is considered warm.
+WARMUP_QUERIES = int(os.environ.get('WARMUP_QUERIES', 20))
+WARMUP_MAX_ROUNDS = int(os.environ.get('WARMUP_MAX_ROUNDS', 5))
+WARMUP_TOLERANCE = float(os.environ.get('WARMUP_TOLERANCE', 0.1))
+
+state = {
+    "live": True,
+    "ready": False,
+    "stage": "starting",
+    "error": None,
+    "warmup": [],
+}
+
+
+def warmup_queries(n: int = WARMUP_QUERIES):
+    """
+    Returns the first n topics of the local TREC topics file, cleaned the same way as user queries.
+
+    :param n: int
+    :return: list
+    """
+    query_path = os.path.join(pathlib.Path(__file__).parent.resolve(), 'topics2021.xml')
+    return [re.sub(r'\W+', ' ', content) for topic_number, content in topics_parser(query_path)[:n]]
+
+
+async def warm_up(queries: list):
+    """
+    Replays the queries against every index through the scoring pool until the p99 latency of a round is within
+    WARMUP_TOLERANCE of the previous round, so that the JVM has compiled the scoring path before traffic arrives.
+    The result cache is bypassed so that every query is really scored.
+
+    :param queries: list
+    :return: list: p50 / p99 latency (ms) of each round
+    """
+    rounds = list()
+    previous_p99 = None
+    for round_number in range(WARMUP_MAX_ROUNDS):
+        latencies = list()
+        for name in retriever_registry.indexes:
+            retriever = retriever_registry.get(name, "BM25", DEFAULT_PAGE_SIZE)
+            for query in queries:
+                start = time.perf_counter()
+                await scoring_executor.run(retriever.transform, query)
+                latencies.append((time.perf_counter() - start) * 1000)
+        p50, p99 = np.percentile(latencies, [50, 99])
+        rounds.append({"round": round_number + 1, "p50_ms": round(float(p50), 2), "p99_ms": round(float(p99), 2)})
+        print(f'warm-up round {round_number + 1}: p50 {p50:.1f} ms, p99 {p99:.1f} ms')
+        if previous_p99 is not None and abs(previous_p99 - p99) <= WARMUP_TOLERANCE * previous_p99:
+            break
+        previous_p99 = p99
+    return rounds
+
+
+async def start():
+    """
+    Loads the indexes and warms the scoring path up, then marks the server as ready. Meant to run as a background task
+    so that /live answers while this is in progress. A failure marks the server as not live.
+
+    :return: None
+    """
+    try:
+        state["stage"] = "loading indexes"
+        await asyncio.to_thread(load_indexes)
+        state["stage"] = "warming up"
+        queries = await asyncio.to_thread(warmup_queries)
+        state["warmup"] = await warm_up(queries)
+        state["stage"] = "ready"
+        state["ready"] = True
+    except Exception as e:
+        print('Error: server startup failed:', e)
+        state["stage"] = "failed"
+        state["error"] = str(e)
+        state["live"] = False  # let the orchestrator restart the process
@@ -1,22 +1,52 @@
 import csv
+import os
+import pathlib
+from functools import lru_cache
 from sklearn.feature_extraction._stop_words import ENGLISH_STOP_WORDS
 from nltk.corpus import stopwords
 
+''' Stopword lists, loaded once per process and shared by the preprocessing, the indexers and the query path '''
+
+CUSTOM_STOPWORD_FILE = os.path.join(pathlib.Path(__file__).parent.resolve(), 'inferred_stopwords.csv')
+
+# path -> (modification time, frozenset of stopwords)
+stopword_cache = dict()
+
+
+def load_stopwords(path: str):
+    """
+    Returns the stopwords stored in the first row of a csv file as a frozenset. The file is only parsed again when its
+    modification time changes.
+
+    :param path: str
+    :return: frozenset
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = stopword_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, "r", newline='') as file:
+        data = list(csv.reader(file, delimiter=","))
+    stopword_set = frozenset(data[0]) if data else frozenset()
+    stopword_cache[path] = (mtime, stopword_set)
+
+    return stopword_set
+
+
 def custom_stopword_list():
-    """ Opens the csv file containing stopword list. Returns a list"""
+    """ Returns the inferred stopword list as a frozenset, cached until the csv file changes """
 
-    file = open("inferred_stopwords.csv", "r")
-    data = list(csv.reader(file, delimiter=","))
-    custom_stopword = data[0]
+    return load_stopwords(CUSTOM_STOPWORD_FILE)
 
-    return custom_stopword
 
+@lru_cache(maxsize=None)
 def standard_stopword_list():
     """ Returns the combined stopword list from NLTK and Scikitlearn """
 
     nltk_stopword = stopwords.words('english')
     sklearn_stopword = ENGLISH_STOP_WORDS
 
-    combined_stopword = set(nltk_stopword).union(set(sklearn_stopword))
+    combined_stopword = frozenset(nltk_stopword).union(sklearn_stopword)
 
     return combined_stopword
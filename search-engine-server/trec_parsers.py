@@ -0,0 +1,112 @@
+from bs4 import BeautifulSoup
+from bson import ObjectId
+from lxml import etree
+from textanalyser import list_words
+import re
+
+''' Parsers of the TREC clinical trials and topics files. They do not import the database layer, so that the ingestion
+and evaluation worker processes can use them without connecting to MongoDB '''
+
+# Tags whose text is used for the term frequencies of a document
+TERM_FREQUENCY_TAGS = ('id_info', 'brief_title', 'acronym', 'official_title', 'sponsors', 'textblock', 'overall_status',
+                       'start_date', 'completion_date', 'primary_completion_date', 'phase', 'study_type',
+                       'study_design_info', 'primary_outcome', 'secondary_outcome', 'other_outcome', 'enrollment',
+                       'condition', 'arm_group', 'intervention', 'overall_official', 'location', 'location_countries',
+                       'keyword', 'condition_browse', 'intervention_browse', 'clinical_results')
+
+
+def topics_parser(query_filepath: str):
+    """
+    Takes the Text Retrieval Conference clinical dataset topics file and returns a list of (topic number, content)
+    tuples in file order.
+
+    :param query_filepath: str
+    :return: list
+    """
+    with open(query_filepath, "r") as f:
+        file = f.read()
+    soup = BeautifulSoup(file, 'lxml')
+    return [(topic.get('number'), topic.text.strip()) for topic in soup.find_all('topic')]
+
+
+def find_domain(url: str):
+    """
+    Takes a URL str and returns the domain substring.
+
+    :param url: str
+    :return: str
+    """
+    if url is None:
+        return None
+    if match := re.search(r"//([a-zA-Z.]+)/", url):
+        return match.group(1)
+    elif match := re.search(r"//([a-zA-Z.]+)$", url):
+        return match.group(1)
+
+
+def clean_text(text: str):
+    """
+    Cleans the text of a tag the same way get_soup_text does.
+
+    :param text: str
+    :return: str
+    """
+    return text.strip().replace('(', ' ').replace(')', ' ').replace('/', ' ').replace("'", "")
+
+
+def parse_clinical_trial(path: str, _id: ObjectId | None = None):
+    """
+    Parses a clinical trial xml file and returns the fields of its database document, without adding it to the
+    database. The file is parsed once with lxml.etree.parse and every field is collected in a single walk over the
+    tree, instead of one BeautifulSoup search per tag.
+
+    An _id can be pre-assigned by the caller, e.g. to know the ids of a batch before it is inserted. Returns None if
+    the file cannot be read or parsed.
+
+    :param path: str: the path of the xml file
+    :param _id: ObjectId | None
+    :return: dict | None
+    """
+    fields = {'brief_title': [], 'brief_summary': [], 'nct_id': []}
+    tf_texts = list()  # texts of the term frequency tags, in document order
+    url = None
+    try:
+        root = etree.parse(path).getroot()
+    except (OSError, etree.XMLSyntaxError) as e:
+        print(f'Error: file {path} could not be processed', e)
+        return None
+    for element in root.iter():
+        tag = element.tag
+        if tag in fields or tag in TERM_FREQUENCY_TAGS or (tag == 'url' and url is None):
+            text = ''.join(element.itertext())
+            if tag in fields:
+                fields[tag].append(clean_text(text))
+            if tag in TERM_FREQUENCY_TAGS:
+                tf_texts.append(clean_text(text))
+            if tag == 'url' and url is None:
+                url = text
+
+    description = ' '.join(fields['brief_summary'])
+    data = {
+        'title': ' '.join(fields['brief_title']),
+        'url': url,
+        'domain': find_domain(url),
+        'description': description.replace('\r\n     ', '').strip() if description else None,
+        'tf_text': ' '.join(tf_texts),
+        'raw_text': ''.join(root.itertext()),
+        'clinical_id': ' '.join(fields['nct_id']),
+    }
+    data['term_frequencies'] = list_words(data['tf_text'])['all']
+    if _id is not None:
+        data['_id'] = _id
+    return data
+
+
+def parse_trial(path: str):
+    """
+    Parses a clinical trial xml file with a new ObjectId, so that it is inserted with its term matrix in one write.
+
+    :param path: str
+    :return: dict | None
+    """
+    return parse_clinical_trial(path, ObjectId())
@@ -1,45 +1,24 @@
 import pandas as pd
-import random
-from db.services_pymongo import documents
-from tqdm import tqdm
-from retrieval_custom_preprocess import custom_preprocess
+from preprocessing import preprocess_documents
 
-import csv
+# Worker processes spawned by this script run it again: only the process running it imports the database (see
+# worker_pool.py)
+if __name__ == '__main__':
+    from db import get_documents_for_indexing_cursor
 
 
 def doc_custom_workaround():
     """
-    returns a dataframe of 5k documents and their clinical_id
+    returns a dataframe of every document and their clinical_id, preprocessed with the dynamic stopword list, and saves
+    it as docs_custom.csv for inspection. The custom index is built from the same pipeline without the csv file.
     """
-    n_docs = 5000
-    corpus = random.sample(list(documents.find({}, {"clinical_id": 1, "raw_text": 1})), n_docs)
-
-    docs = pd.DataFrame(corpus)
-    docs = docs[['clinical_id', 'raw_text']]
-    docs.rename(columns={'clinical_id': 'docno', 'raw_text': 'text'}, inplace=True)
-
-    docs_custom = docs.copy()
-    docs_custom['text2'] = ''
-
-    for i in tqdm(range(len(docs_custom))):
-        text = docs_custom.iloc[i].text
-        removed = custom_preprocess(text)
-        docs_custom.loc[i, 'text2'] = removed
-
-    docs_custom = docs_custom.drop(['text'], axis=1)
-    docs_custom = docs_custom.rename(columns={"text2": "text"})
+    docs_custom = pd.DataFrame(preprocess_documents(get_documents_for_indexing_cursor()), columns=['docno', 'text'])
 
     docs_custom.to_csv('docs_custom.csv')
 
     return docs_custom
 
-docs_custom = doc_custom_workaround()
-
-
-
-# file = open("docs_custom.csv", "r")
-# data = list(csv.reader(file, delimiter=","))
-
-# docs_custom = pd.read_csv('docs_custom.csv')
-# print(docs_custom)
 
+# Run this file as standalone to export docs_custom.csv
+if __name__ == '__main__':
+    docs_custom = doc_custom_workaround()
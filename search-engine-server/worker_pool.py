@@ -0,0 +1,34 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+''' Worker processes of the ingestion, preprocessing, sharded search and evaluation pools '''
+
+# Every pool starts its workers with the spawn method, so that they do not inherit the JVM threads or the MongoDB
+# connection of the parent process. A spawned worker runs the script the parent was started with again, as
+# __mp_main__: the scripts that start pools (main.py, data_processing.py, evaluation.py, benchmark.py,
+# work_around_df.py) only import the server, Terrier and database modules under their __main__ guard, and the
+# functions run by the workers live in modules that do not import the database.
+spawn_context = multiprocessing.get_context('spawn')
+
+
+def process_pool(processes: int, initializer=None, initargs: tuple = ()):
+    """
+    Returns a multiprocessing Pool of spawned worker processes, all started straight away, each running
+    initializer(*initargs) first.
+
+    :param processes: int
+    :param initializer: callable | None
+    :param initargs: tuple
+    :return: Pool
+    """
+    return spawn_context.Pool(max(1, processes), initializer=initializer, initargs=initargs)
+
+
+def process_executor(max_workers: int):
+    """
+    Returns a ProcessPoolExecutor of spawned worker processes.
+
+    :param max_workers: int
+    :return: ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers=max(1, max_workers), mp_context=spawn_context)